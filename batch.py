@@ -0,0 +1,558 @@
+import argparse
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+import traceback
+import tracemalloc
+from dataclasses import asdict, fields
+from functools import partial
+
+import numpy as np
+
+from cache import PreloadedVolumes, save_nifti
+from ex3 import MemoryBudget, OutputFormat, PipelineContext, SegmentationMetrics, Tracer, evaluateSegmentation, \
+    segmentLiver, segment_context
+
+MANIFEST_COLUMNS = ('ct', 'aorta', 'output')
+PAIR_COLUMNS = ('ground_truth', 'estimated')
+SUMMARY_FIELDS = ['case', 'status', 'runtime_s', 'peak_memory_mb', 'output', 'error']
+METRIC_FIELDS = [field.name for field in fields(SegmentationMetrics)]
+REPORT_FIELDS = ['case', 'status'] + METRIC_FIELDS + ['runtime_s', 'ground_truth', 'estimated', 'error']
+PIPELINE_FIELDS = SUMMARY_FIELDS + ['load_s', 'wait_s', 'compute_s', 'save_wait_s', 'write_s']
+PREFETCH_DEPTH = 1  # cases that are loaded ahead of the case that is processed
+WRITE_QUEUE_SIZE = 2  # segmentations that may wait for the background writer before the next case is blocked
+QUEUE_POLL_S = 0.1
+AGGREGATES = {'mean': np.mean, 'std': np.std, 'median': np.median, 'min': np.min, 'max': np.max}
+
+
+##############
+# USER GUIDE #
+##############
+# Runs segmentLiver on many cases in parallel:
+#     python batch.py segment manifest.csv --workers 4 --scratch scratch --summary summary.csv
+# The manifest is a CSV file with the columns ct, aorta and output, or a JSON list of objects with these keys. Relative
+# paths are relative to the working directory, and output is the name of the segmentation file without an extension, as
+# in segmentLiver. Every case runs in its own process with its own scratch directory (named after the output file),
+# which holds the printed log of the case with the summary of its stages, its JSON trace (trace.json, see Tracer in
+# ex3.py) and its intermediate nii.gz files if --save-debug is given, so parallel cases never overwrite each other's
+# files. The segmentations are uint8 files, compressed with --compress-level (see cache.save_nifti) or uncompressed
+# '.nii' files if --no-compress is given
+# Evaluates many segmentations in parallel:
+#     python batch.py evaluate pairs.csv --workers 4 --report report
+# The pairs file is a CSV file with the columns ground_truth and estimated (and optionally case), or a JSON list of
+# objects with these keys. The metrics of evaluateSegmentation and the runtime of every case, followed by their mean,
+# std, median, min and max over the successful cases, are written to report.csv and report.json
+# Passing --prefetch N to either command pipelines the I/O: every worker process gets an equal share of the cases and
+# runs them one after the other, while a background thread loads and decompresses the input files of the next N cases.
+# The segmentations and the debug files are compressed and saved by another background thread, and at most
+# --write-queue files wait for it before the next case waits too. The summary table then also has the time that every
+# case spent loading, waiting for its inputs, computing, waiting for the writer and being written. The trace of a case
+# includes its loading, but it does not measure the memory of its stages, because the background threads allocate
+# memory at the same time
+
+
+def read_manifest(manifest_file_name, columns=MANIFEST_COLUMNS):
+    """
+    A function that reads a manifest (of cases, pairs to evaluate or cases of a sweep) from a CSV or JSON file
+    :param columns: The required columns of the manifest, which are paths
+    :return the function returns a list of dicts with the absolute paths of the given columns of every row, and with
+    its 'case' name if the manifest has a case column
+    """
+    with open(manifest_file_name) as f:
+        if manifest_file_name.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    cases = []
+    for row in rows:
+        case = {column: os.path.abspath(row[column]) for column in columns}
+        if row.get('case'):
+            case['case'] = row['case']
+        cases.append(case)
+    return cases
+
+
+def error_message(e):
+    """
+    A function that returns the message of the given exception with its type, for the error fields of the tables
+    """
+    return '%s: %s' % (type(e).__name__, e)
+
+
+def case_names(cases):
+    """
+    A function that returns a unique name for every case, based on the name of its output file
+    """
+    names = []
+    for case in cases:
+        name = os.path.basename(case['output']).split('.nii')[0]
+        if name in names:
+            name = '%s_%d' % (name, len(names))
+        names.append(name)
+    return names
+
+
+def peak_memory_mb():
+    """
+    A function that returns the peak resident memory of the current process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case, scratch_dir, **segmentation_options):
+    """
+    A function that segments a single case inside the given scratch directory. The working directory is the scratch
+    directory while the case runs, and everything it prints is written to 'log.txt' in it, followed by the summary of
+    its stages. The trace of the stages is written to 'trace.json' in it
+    :param segmentation_options: Keyword arguments for segmentLiver
+    :return the function returns a dict with the fields of the summary table, see SUMMARY_FIELDS
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    output_format = segmentation_options.get('output_format') or OutputFormat()
+    result = {'case': os.path.basename(scratch_dir), 'status': 'ok', 'output': case['output'] + output_format.extension,
+              'error': ''}
+    start = time.perf_counter()
+    cwd = os.getcwd()
+    tracer = Tracer()
+    try:
+        os.chdir(scratch_dir)
+        with open('log.txt', 'w') as log, contextlib.redirect_stdout(log):
+            try:
+                segmentLiver(case['ct'], case['aorta'], case['output'], debug_dir=scratch_dir, tracer=tracer,
+                             **segmentation_options)
+            finally:
+                print(tracer.summary())
+                tracer.to_json('trace.json')
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = error_message(e)
+        with open(os.path.join(scratch_dir, 'error.txt'), 'w') as f:
+            f.write(traceback.format_exc())
+    finally:
+        os.chdir(cwd)
+    result['runtime_s'] = round(time.perf_counter() - start, 3)
+    result['peak_memory_mb'] = round(peak_memory_mb(), 1)
+    return result
+
+
+def run_indexed_case(indexed_case, scratch_root, **segmentation_options):
+    """
+    A function that runs run_case for an (index, name, case) tuple and returns the index with the result, for the pool
+    """
+    index, name, case = indexed_case
+    return index, run_case(case, os.path.join(scratch_root, name), **segmentation_options)
+
+
+def run_batch(cases, workers=None, scratch_root='scratch', summary_file_name=None, **segmentation_options):
+    """
+    A function that segments all the given cases in a pool of worker processes. Every worker process handles a single
+    case, so the peak memory of a case is the peak memory of its process
+    :param cases: A list of dicts with 'ct', 'aorta' and 'output' keys, see read_manifest
+    :param workers: The number of worker processes, by default the number of CPUs
+    :param scratch_root: The directory in which the scratch directory of every case is created
+    :param summary_file_name: If given, the summary table is written to this CSV file
+    :param segmentation_options: Keyword arguments for segmentLiver, e.g. save_debug or rng
+    :return the function returns the summary table as a list of dicts, in the order of the cases
+    """
+    indexed_cases = list(zip(range(len(cases)), case_names(cases), cases))
+    results = [None] * len(cases)
+    with multiprocessing.Pool(workers, maxtasksperchild=1) as pool:
+        run = partial(run_indexed_case, scratch_root=os.path.abspath(scratch_root), **segmentation_options)
+        for index, result in pool.imap_unordered(run, indexed_cases):
+            results[index] = result
+            print('%-30s %-8s %8.1f s %8.1f MB' % (result['case'], result['status'], result['runtime_s'],
+                                                   result['peak_memory_mb']))
+
+    if summary_file_name is not None:
+        write_table(results, summary_file_name, SUMMARY_FIELDS)
+    return results
+
+
+def split_shares(items, workers=None):
+    """
+    A function that divides the given items between the given number of workers (by default the number of CPUs), in
+    round robin so the shares have similar sizes
+    :return the function returns a list of non empty lists of items
+    """
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    return [items[worker::workers] for worker in range(workers)]
+
+
+class Prefetcher:
+    """
+    A class that loads the given items with the given load function in a background thread, at most depth items ahead
+    of the item that was taken from it last. An item is loaded only when fewer than depth loaded items wait to be
+    taken, so the item that is processed and at most depth loaded items are in memory at once. Iterating over it yields
+    (item, loaded, error, load_s) tuples in the order of the items, where error is the exception that load raised (and
+    loaded is None), and load_s is the loading time
+    """
+
+    def __init__(self, items, load, depth=PREFETCH_DEPTH):
+        self._queue = queue.Queue()
+        self._free_slots = threading.Semaphore(max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(list(items), load), daemon=True)
+        self._thread.start()
+
+    def _run(self, items, load):
+        for item in items:
+            # wait until a loaded item is taken, or until the prefetcher is closed:
+            while not self._free_slots.acquire(timeout=QUEUE_POLL_S):
+                if self._stop.is_set():
+                    return
+            if self._stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                loaded, error = load(item), None
+            except Exception as e:
+                loaded, error = None, e
+            self._queue.put((item, loaded, error, time.perf_counter() - start))
+        self._queue.put(None)
+
+    def __iter__(self):
+        for value in iter(self._queue.get, None):
+            self._free_slots.release()
+            yield value
+
+    def close(self):
+        """
+        A function that stops loading items and waits for the background thread
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BackgroundWriter:
+    """
+    A class that saves nifti images in a background thread with cache.save_nifti. At most queue_size images wait to be
+    saved, so write blocks (back-pressure) when the disk is slower than the computation of the images. The errors and
+    the saving times of the files are kept by their names
+    """
+
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE, output_format=None):
+        self.output_format = output_format or OutputFormat()
+        self.errors = {}
+        self.write_s = {}
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, img, file_name):
+        """
+        A function that queues the given image to be saved as file_name
+        :return the function returns the time in seconds that it waited for room in the queue
+        """
+        start = time.perf_counter()
+        self._queue.put((img, file_name))
+        return time.perf_counter() - start
+
+    def _run(self):
+        for img, file_name in iter(self._queue.get, None):
+            start = time.perf_counter()
+            try:
+                save_nifti(img, file_name, self.output_format.compress_level, self.output_format.threads)
+            except Exception as e:
+                self.errors[file_name] = e
+            self.write_s[file_name] = time.perf_counter() - start
+
+    def close(self):
+        """
+        A function that waits until all the queued images are saved
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_case(indexed_case, scratch_root, tracer_factory=Tracer, budget_factory=None, **context_options):
+    """
+    A function that creates the scratch directory and the PipelineContext of an (index, name, case) tuple, for the
+    Prefetcher of run_pipelined_share. The context gets a new tracer (and memory budget) from the given factories, so
+    the loading of the case is traced like in run_case
+    :param context_options: Keyword arguments for PipelineContext, e.g. save_debug or volume_cache
+    """
+    _, name, case = indexed_case
+    scratch_dir = os.path.join(scratch_root, name)
+    os.makedirs(scratch_dir, exist_ok=True)
+    memory_budget = budget_factory() if budget_factory is not None else None
+    return PipelineContext(case['ct'], case['aorta'], memory_budget=memory_budget, debug_dir=scratch_dir,
+                           tracer=tracer_factory(), **context_options)
+
+
+def run_pipelined_share(indexed_cases, scratch_root, prefetch=PREFETCH_DEPTH, write_queue_size=WRITE_QUEUE_SIZE,
+                        rng=None, params=None, memory_budget=None, output_format=None, **context_options):
+    """
+    A function that segments a share of the cases one after the other in the current process. The CT and aorta files
+    of the next cases are loaded by a Prefetcher while the current case is segmented, and the segmentations and the
+    debug files are saved by a BackgroundWriter. Every case has a scratch directory as in run_case, with its log, trace
+    and debug files
+    :param indexed_cases: A list of (index, name, case) tuples, see run_indexed_case
+    :param prefetch: The number of cases that are loaded ahead of the current case
+    :param write_queue_size: The number of segmentations and debug files that may wait for the writer
+    :param rng: A seed for the selection of the seeds, see segmentLiver
+    :param params: A SegmentationParams, see segmentLiver
+    :param memory_budget: A limit in bytes or a MemoryBudget, see segmentLiver. Every case gets its own MemoryBudget
+    with the same limit, and the memory is traced while the share runs
+    :param output_format: The OutputFormat of the segmentations and of the debug files
+    :param context_options: The other keyword arguments of segmentLiver, e.g. save_debug, volume_cache, stage_cache or
+    slab_size
+    :return the function returns a list of (index, result) pairs, where every result is a dict with the fields of the
+    pipelined summary table, see PIPELINE_FIELDS
+    """
+    output_format = output_format or OutputFormat()
+    tracer_factory = partial(Tracer, trace_memory=False)
+    budget_factory = None
+    if memory_budget is not None:
+        if isinstance(memory_budget, MemoryBudget):
+            budget_factory = partial(MemoryBudget, memory_budget.limit, memory_budget.on_exceed)
+        else:
+            budget_factory = partial(MemoryBudget, memory_budget)
+    # the budgets of a case that is loaded and of a case that is segmented are used at once, so the memory is traced
+    # for the whole share instead of by every budget:
+    started_tracing = budget_factory is not None and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    results = []
+    try:
+        with BackgroundWriter(write_queue_size, output_format) as writer:
+            load = partial(load_case, scratch_root=scratch_root, tracer_factory=tracer_factory,
+                           budget_factory=budget_factory, output_format=output_format, image_writer=writer.write,
+                           **context_options)
+            with Prefetcher(indexed_cases, load, prefetch) as prefetcher:
+                start = time.perf_counter()
+                for (index, name, case), context, error, load_s in prefetcher:
+                    scratch_dir = os.path.join(scratch_root, name)
+                    result = {'case': name, 'status': 'ok', 'output': case['output'] + output_format.extension,
+                              'error': '', 'load_s': round(load_s, 3), 'wait_s': round(time.perf_counter() - start, 3)}
+                    tracer = context.tracer if context is not None else tracer_factory()
+                    try:
+                        if error is not None:
+                            raise error
+                        compute_start = time.perf_counter()
+                        liver_data = segment_context(context, rng, params)
+                        result['compute_s'] = round(time.perf_counter() - compute_start, 3)
+                        with context.stage('save'):
+                            img = context.to_image(liver_data)
+                            result['save_wait_s'] = round(writer.write(img, result['output']), 3)
+                    except Exception as e:
+                        result['status'] = 'failed'
+                        result['error'] = error_message(e)
+                        with open(os.path.join(scratch_dir, 'error.txt'), 'w') as f:
+                            f.write(traceback.format_exc())
+                    finally:
+                        if context is not None and context.memory_budget is not None:
+                            tracer.event('memory_budget', limit=context.memory_budget.limit,
+                                         degraded_stages=list(context.memory_budget.degraded_stages))
+                        with open(os.path.join(scratch_dir, 'log.txt'), 'w') as log:
+                            print(tracer.summary(), file=log)
+                        tracer.to_json(os.path.join(scratch_dir, 'trace.json'))
+                    # the volumes of the case are released before the next case is taken:
+                    context = liver_data = img = None
+                    result['runtime_s'] = round(time.perf_counter() - start, 3)
+                    results.append((index, result))
+                    start = time.perf_counter()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+
+    # the writer is closed, so all the segmentations and debug files were saved. A case fails if any of its files
+    # could not be saved:
+    for index, result in results:
+        scratch_dir = os.path.join(scratch_root, result['case'])
+        for file_name, e in writer.errors.items():
+            if file_name == result['output'] or os.path.dirname(file_name) == scratch_dir:
+                result['status'] = 'failed'
+                result['error'] = error_message(e)
+        if result['output'] in writer.write_s:
+            result['write_s'] = round(writer.write_s[result['output']], 3)
+        result['peak_memory_mb'] = round(peak_memory_mb(), 1)
+    return results
+
+
+def run_pipelined_batch(cases, workers=None, scratch_root='scratch', summary_file_name=None, prefetch=PREFETCH_DEPTH,
+                        write_queue_size=WRITE_QUEUE_SIZE, **segmentation_options):
+    """
+    A function that segments all the given cases in a pool of worker processes, where every worker process runs a
+    share of the cases with run_pipelined_share. The peak memory of a case is the peak memory of its worker process
+    until the end of its share
+    :param segmentation_options: Keyword arguments for run_pipelined_share, e.g. save_debug or rng
+    :return the function returns the summary table as a list of dicts, in the order of the cases, see run_batch
+    """
+    shares = split_shares(list(zip(range(len(cases)), case_names(cases), cases)), workers)
+    results = [None] * len(cases)
+    with multiprocessing.Pool(len(shares) or 1, maxtasksperchild=1) as pool:
+        run = partial(run_pipelined_share, scratch_root=os.path.abspath(scratch_root), prefetch=prefetch,
+                      write_queue_size=write_queue_size, **segmentation_options)
+        for share_results in pool.imap_unordered(run, shares):
+            for index, result in share_results:
+                results[index] = result
+                print('%-30s %-8s %8.1f s %8.1f MB' % (result['case'], result['status'], result['runtime_s'],
+                                                       result['peak_memory_mb']))
+
+    if summary_file_name is not None:
+        write_table(results, summary_file_name, PIPELINE_FIELDS)
+    return results
+
+
+def evaluate_pair(pair, volume_cache=None):
+    """
+    A function that evaluates a single pair with evaluateSegmentation. A pair without a case name is named after its
+    estimated segmentation
+    :param volume_cache: A cache.VolumeCache or PreloadedVolumes to load the segmentations through
+    :return the function returns a dict with the fields of the report, see REPORT_FIELDS
+    """
+    case = pair.get('case') or os.path.basename(pair['estimated']).split('.nii')[0]
+    result = {'case': case, 'status': 'ok', 'ground_truth': pair['ground_truth'], 'estimated': pair['estimated'],
+              'error': ''}
+    start = time.perf_counter()
+    try:
+        metrics = evaluateSegmentation(pair['ground_truth'], pair['estimated'], volume_cache=volume_cache)
+        result.update({name: float(value) for name, value in asdict(metrics).items()})
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = error_message(e)
+    result['runtime_s'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def evaluate_pipelined_share(indexed_pairs, prefetch=PREFETCH_DEPTH):
+    """
+    A function that evaluates a share of the pairs one after the other in the current process, while a Prefetcher
+    reads the files of the next pairs into PreloadedVolumes
+    :param indexed_pairs: A list of (index, pair) tuples
+    :return the function returns a list of (index, result) pairs, see evaluate_pair
+    """
+    def load(indexed_pair):
+        _, pair = indexed_pair
+        return PreloadedVolumes([pair['ground_truth'], pair['estimated']])
+
+    results = []
+    with Prefetcher(indexed_pairs, load, prefetch) as prefetcher:
+        for (index, pair), volumes, error, load_s in prefetcher:
+            # a pair whose files could not be read is evaluated from the files, which reports the error:
+            result = evaluate_pair(pair, volumes)
+            result['load_s'] = round(load_s, 3)
+            results.append((index, result))
+    return results
+
+
+def evaluate_batch(pairs, workers=None, report_prefix=None, prefetch=None):
+    """
+    A function that evaluates all the given pairs in a pool of worker processes. The evaluation does not write any
+    file, so the pairs are independent
+    :param pairs: A list of dicts with 'ground_truth' and 'estimated' keys and optionally 'case', see read_manifest
+    :param workers: The number of worker processes, by default the number of CPUs
+    :param report_prefix: If given, the report is written to '<report_prefix>.csv' and '<report_prefix>.json'
+    :param prefetch: If given, every worker process evaluates a share of the pairs with evaluate_pipelined_share and
+    reads the files of this number of pairs ahead
+    :return the function returns the per-case results as a list of dicts in the order of the pairs, and a dict with
+    the aggregate statistics of every metric over the successful cases
+    """
+    with multiprocessing.Pool(workers) as pool:
+        if prefetch is None:
+            results = pool.map(evaluate_pair, pairs, chunksize=1)
+        else:
+            results = [None] * len(pairs)
+            run = partial(evaluate_pipelined_share, prefetch=prefetch)
+            for share_results in pool.imap_unordered(run, split_shares(list(enumerate(pairs)), workers)):
+                for index, result in share_results:
+                    results[index] = result
+    aggregate = aggregate_metrics(results)
+
+    if report_prefix is not None:
+        aggregate_rows = [dict(statistics, case=name, status='aggregate') for name, statistics in aggregate.items()]
+        write_table(results + aggregate_rows, report_prefix + '.csv', REPORT_FIELDS)
+        with open(report_prefix + '.json', 'w') as f:
+            json.dump({'cases': results, 'aggregate': aggregate}, f, indent=2)
+    return results, aggregate
+
+
+def aggregate_metrics(results):
+    """
+    A function that computes the statistics in AGGREGATES of every metric and of the runtime over the successful
+    results
+    :return the function returns a dict from the name of the statistic to a dict from a field to its value
+    """
+    ok_results = [result for result in results if result['status'] == 'ok']
+    if not ok_results:
+        return {}
+    aggregate = {}
+    for name, statistic in AGGREGATES.items():
+        aggregate[name] = {field: float(statistic([result[field] for result in ok_results]))
+                           for field in METRIC_FIELDS + ['runtime_s']}
+    return aggregate
+
+
+def write_table(rows, file_name, fields):
+    """
+    A function that writes the given rows (dicts) to a CSV file with the given columns
+    """
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment or evaluate many cases in parallel')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    segment_parser = subparsers.add_parser('segment', help='segment the liver in many CT scans')
+    segment_parser.add_argument('manifest', help='a CSV or JSON file with the ct, aorta and output of every case')
+    segment_parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    segment_parser.add_argument('--scratch', default='scratch',
+                                help='directory for the scratch directories of the cases')
+    segment_parser.add_argument('--summary', default='summary.csv', help='CSV file for the summary table')
+    segment_parser.add_argument('--save-debug', action='store_true', help='save the intermediate nii.gz files')
+    segment_parser.add_argument('--seed', type=int, default=None, help='seed for the selection of the seeds')
+    segment_parser.add_argument('--compress-level', type=int, default=OutputFormat.compress_level,
+                                help='gzip level of the segmentations, from 0 (fastest) to 9 (smallest)')
+    segment_parser.add_argument('--no-compress', action='store_true', help='save uncompressed .nii segmentations')
+    segment_parser.add_argument('--prefetch', type=int, default=None,
+                                help='pipeline the I/O and load the inputs of this number of cases ahead')
+    segment_parser.add_argument('--write-queue', type=int, default=WRITE_QUEUE_SIZE,
+                                help='segmentations that may wait to be saved in the pipelined mode')
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='evaluate many segmentations against the ground truth')
+    evaluate_parser.add_argument('pairs', help='a CSV or JSON file with the ground_truth and estimated of every case')
+    evaluate_parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    evaluate_parser.add_argument('--report', default='report', help='prefix of the CSV and JSON report files')
+    evaluate_parser.add_argument('--prefetch', type=int, default=None,
+                                 help='pipeline the I/O and read the files of this number of pairs ahead')
+    args = parser.parse_args()
+
+    if args.command == 'segment':
+        options = dict(save_debug=args.save_debug, rng=args.seed,
+                       output_format=OutputFormat(compressed=not args.no_compress, compress_level=args.compress_level))
+        if args.prefetch is not None:
+            summary = run_pipelined_batch(read_manifest(args.manifest), args.workers, args.scratch, args.summary,
+                                          args.prefetch, args.write_queue, **options)
+        else:
+            summary = run_batch(read_manifest(args.manifest), args.workers, args.scratch, args.summary, **options)
+    else:
+        summary, statistics = evaluate_batch(read_manifest(args.pairs, PAIR_COLUMNS), args.workers, args.report,
+                                             args.prefetch)
+        for field in ('VOD', 'dice_coefficient', 'ASSD', 'hausdorff_95'):
+            if statistics:
+                print('%-18s mean %.4f  std %.4f' % (field, statistics['mean'][field], statistics['std'][field]))
+    failed = [result['case'] for result in summary if result['status'] != 'ok']
+    print('%d cases, %d failed%s' % (len(summary), len(failed), (': ' + ', '.join(failed)) if failed else ''))
@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from dataclasses import replace
+
+import nibabel as nib
+import numpy as np
+from nibabel import orientations
+
+import ex3
+from ex3 import (PipelineContext, SegmentationParams, IsolateBody, calc_ASSD, evaluateSegmentation, find_ROI,
+                 find_seeds, multipleSeedsRG, segmentLiver)
+
+BENCHMARK_SIZES = {'small': (128, 128, 16), 'medium': (256, 256, 32), 'large': (512, 512, 64)}
+BENCHMARK_REPEATS = 3
+RESULTS_FILE_NAME = 'benchmark_results.jsonl'
+PHANTOM_SPACING = (0.8, 0.8, 2.5)  # mm
+PHANTOM_NOISE = 5  # std of the noise in HU
+REFERENCE_WIDTH = 320  # width of the phantom for which the default SegmentationParams fit
+
+# HU values of the tissues of the phantom:
+AIR_HU = -1000
+FAT_HU = -110
+SOFT_TISSUE_HU = 30
+LIVER_HU = 80
+AORTA_HU = 250
+BONE_HU = 700
+
+
+##############
+# USER GUIDE #
+##############
+# Times the public functions of ex3.py on synthetic CT phantoms, so no patient data is needed:
+#     python benchmark.py --sizes small medium --repeats 3
+# A phantom is a CT volume of a body (soft tissue inside a layer of fat) lying on a table, with a spine, an aorta tube
+# and a liver-like ellipsoid, together with the segmentations of the aorta and of the liver. make_phantom writes the
+# three nii.gz files in any orientation that segmentLiver handles
+# The results of every run are appended to benchmark_results.jsonl together with the current git commit, and the
+# times are printed next to the times of the most recent run of another commit, so regressions can be spotted
+# The phantoms are written to a temporary directory, or to --data-dir to keep them for ITK-Snap
+# With --levels 1 2 3, segmentLiver is also timed with every number of resolutions of the region growing, and its
+# segmentation is scored with evaluateSegmentation against the ground truth and against the single resolution
+# segmentation, which shows the speed and accuracy trade-off of the coarse to fine region growing
+
+
+def make_phantom(directory, shape, orientation='RPS', spacing=PHANTOM_SPACING, seed=0):
+    """
+    A function that creates a synthetic CT scan with the segmentations of its aorta and of its liver. The anatomy is
+    drawn in proportion to the shape, in the 'R,P,S' orientation that the algorithm works in, and then flipped to the
+    given orientation
+    :param directory: The directory in which 'phantom_CT.nii.gz', 'phantom_Aorta.nii.gz' and 'phantom_liver.nii.gz' are
+    written
+    :param shape: The shape of the volume, the first two axes are the axial plane
+    :param orientation: The axis codes of the files, e.g. 'RPS' or 'LAS'
+    :param spacing: The voxel spacing in mm
+    :param seed: The seed of the noise
+    :return the function returns the paths to the CT, aorta and liver files
+    """
+    rng = np.random.default_rng(seed)
+    width, height, depth = shape
+    x, y, z = np.ogrid[:width, :height, :depth]
+    x, y, z = x / width, y / height, (z + 0.5) / depth
+
+    body = ((x - 0.5) / 0.47) ** 2 + ((y - 0.5) / 0.34) ** 2 <= 1
+    inner_body = ((x - 0.5) / 0.45) ** 2 + ((y - 0.5) / 0.32) ** 2 <= 1
+    spine = (x - 0.5) ** 2 + ((y - 0.74) * width / height) ** 2 <= 0.04 ** 2
+    table = (0.1 <= x) & (x <= 0.9) & (0.89 <= y) & (y <= 0.905)
+    aorta = ((x - 0.47) ** 2 + ((y - 0.59) * height / width) ** 2 <= 0.025 ** 2) & (1 / 6 <= z) & (z <= 5 / 6)
+    liver = ((x - 0.72) / 0.17) ** 2 + ((y - 0.47) / 0.14) ** 2 + ((z - 0.5) / 0.42) ** 2 <= 1
+
+    ct_data = np.full(shape, AIR_HU, dtype=np.float32)
+    ct_data[np.broadcast_to(body, shape)] = FAT_HU
+    ct_data[np.broadcast_to(inner_body, shape)] = SOFT_TISSUE_HU
+    ct_data[np.broadcast_to(spine, shape)] = BONE_HU
+    ct_data[np.broadcast_to(table, shape)] = SOFT_TISSUE_HU + 70
+    ct_data[liver] = LIVER_HU
+    ct_data[aorta] = AORTA_HU
+    ct_data = (ct_data + rng.normal(0, PHANTOM_NOISE, shape)).astype(np.int16)
+
+    # flip the volumes from 'R,P,S' to the given orientation:
+    transform = orientations.ornt_transform(orientations.axcodes2ornt(('R', 'P', 'S')),
+                                            orientations.axcodes2ornt(tuple(orientation)))
+    if not np.array_equal(transform[:, 0], np.arange(3)):
+        raise ValueError('The orientation %r permutes the axes, only flips of R,P,S are supported' % (orientation,))
+    affine = np.diag([spacing[0], -spacing[1], spacing[2], 1.0]).dot(orientations.inv_ornt_aff(transform, shape))
+
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    for name, data in (('CT', ct_data), ('Aorta', aorta.astype(np.uint8)), ('liver', liver.astype(np.uint8))):
+        file_name = os.path.join(directory, 'phantom_%s.nii.gz' % name)
+        nib.save(nib.Nifti1Image(orientations.apply_orientation(data, transform), affine), file_name)
+        file_names.append(file_name)
+    return tuple(file_names)
+
+
+def phantom_params(shape):
+    """
+    A function that returns the SegmentationParams for a phantom of the given shape. The lengths in voxels (the skin
+    radius and the seed offset) are scaled with the width of the phantom
+    """
+    scale = shape[0] / REFERENCE_WIDTH
+    defaults = SegmentationParams()
+    return SegmentationParams(skin_radius=max(1, round(defaults.skin_radius * scale)),
+                              seed_offset=round(defaults.seed_offset * scale))
+
+
+def benchmark_functions(ct_file_name, aorta_file_name, liver_file_name, output_file_name, params):
+    """
+    A function that returns the benchmarks of a phantom, as a list of (name, setup, run) tuples. setup prepares the
+    inputs of a single run without being timed, and run receives them and calls the benchmarked function
+    """
+    def new_context():
+        return PipelineContext(ct_file_name, aorta_file_name)
+
+    def context_with_ROI():
+        context = new_context()
+        return context, find_ROI(context, params=params)
+
+    def clear_surface_cache():
+        ex3._surface_cache.clear()
+
+    return [
+        ('IsolateBody', new_context, IsolateBody),
+        ('find_ROI', new_context, lambda context: find_ROI(context, params=params)),
+        ('find_seeds', context_with_ROI, lambda inputs: find_seeds(*inputs, rng=0, params=params)),
+        ('multipleSeedsRG', context_with_ROI, lambda inputs: multipleSeedsRG(*inputs, rng=0, params=params)),
+        ('segmentLiver', lambda: None,
+         lambda _: segmentLiver(ct_file_name, aorta_file_name, output_file_name, rng=0, params=params)),
+        ('calc_ASSD', clear_surface_cache, lambda _: calc_ASSD(liver_file_name, output_file_name + '.nii.gz')),
+        ('evaluateSegmentation', clear_surface_cache,
+         lambda _: evaluateSegmentation(liver_file_name, output_file_name + '.nii.gz')),
+    ]
+
+
+def time_function(setup, run, repeats):
+    """
+    A function that times the given function repeats times, each time on new inputs from setup
+    :return the function returns the times of the runs in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        inputs = setup()
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(sizes, repeats=BENCHMARK_REPEATS, orientation='RPS', data_dir=None, levels=()):
+    """
+    A function that times all the benchmarks on phantoms of the given sizes
+    :param sizes: Names of BENCHMARK_SIZES
+    :param data_dir: The directory of the phantoms, by default a temporary directory
+    :param levels: Numbers of resolutions of the region growing to compare, see resolution_tradeoff
+    :return the function returns a list of result dicts, one for every size and function
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            shape = BENCHMARK_SIZES[size]
+            directory = os.path.join(data_dir or temp_dir, '%s_%s' % (size, orientation))
+            ct_file_name, aorta_file_name, liver_file_name = make_phantom(directory, shape, orientation)
+            output_file_name = os.path.join(directory, 'phantom_segmentation')
+            for name, setup, run in benchmark_functions(ct_file_name, aorta_file_name, liver_file_name,
+                                                        output_file_name, phantom_params(shape)):
+                times = time_function(setup, run, repeats)
+                results.append({'size': size, 'shape': list(shape), 'orientation': orientation, 'function': name,
+                                'best_s': min(times), 'median_s': float(np.median(times)), 'repeats': repeats})
+                print('%-8s %-22s %10.4f s' % (size, name, min(times)))
+            results.append({'size': size, 'shape': list(shape), 'orientation': orientation, 'function': 'dice',
+                            'value': evaluateSegmentation(liver_file_name, output_file_name + '.nii.gz')
+                            .dice_coefficient})
+            for result in resolution_tradeoff(ct_file_name, aorta_file_name, liver_file_name, output_file_name,
+                                              phantom_params(shape), levels, repeats):
+                results.append(dict(result, size=size, shape=list(shape), orientation=orientation))
+    return results
+
+
+def resolution_tradeoff(ct_file_name, aorta_file_name, liver_file_name, single_file_name, params, levels, repeats):
+    """
+    A function that times segmentLiver with every given number of resolutions of the region growing, and scores its
+    segmentation against the ground truth and against the single resolution segmentation in single_file_name
+    :return the function returns a list of result dicts, with the time, the dice coefficient and ASSD against the
+    ground truth and the dice coefficient against the single resolution segmentation of every number of resolutions
+    """
+    results = []
+    for growing_levels in levels:
+        output_file_name = '%s_levels%d' % (single_file_name, growing_levels)
+        level_params = replace(params, growing_levels=growing_levels)
+        times = time_function(lambda: None, lambda _: segmentLiver(ct_file_name, aorta_file_name, output_file_name,
+                                                                   rng=0, params=level_params), repeats)
+        truth_metrics = evaluateSegmentation(liver_file_name, output_file_name + '.nii.gz')
+        single_metrics = evaluateSegmentation(single_file_name + '.nii.gz', output_file_name + '.nii.gz')
+        name = 'levels_%d' % growing_levels
+        results.extend([
+            {'function': 'segmentLiver_' + name, 'best_s': min(times), 'median_s': float(np.median(times)),
+             'repeats': repeats},
+            {'function': 'dice_' + name, 'value': truth_metrics.dice_coefficient},
+            {'function': 'ASSD_' + name, 'value': truth_metrics.ASSD},
+            {'function': 'dice_vs_single_' + name, 'value': single_metrics.dice_coefficient},
+        ])
+        print('%-22s %10.4f s  dice %.4f  ASSD %.3f mm  dice vs single resolution %.4f' %
+              ('levels=%d' % growing_levels, min(times), truth_metrics.dice_coefficient, truth_metrics.ASSD,
+               single_metrics.dice_coefficient))
+    return results
+
+
+def git_commit():
+    """
+    A function that returns the current git commit and whether the working tree has changes, or (None, None) outside
+    of a git repository
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def record_results(results, results_file_name=RESULTS_FILE_NAME):
+    """
+    A function that appends the given results to the results file as a single JSON line, with the current commit and
+    the versions of the environment
+    :return the function returns the recorded run
+    """
+    commit, dirty = git_commit()
+    run = {'commit': commit, 'dirty': dirty, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'numpy': np.__version__, 'results': results}
+    with open(results_file_name, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return run
+
+
+def previous_run(run, results_file_name=RESULTS_FILE_NAME):
+    """
+    A function that returns the most recent recorded run of another commit than the given run, or None
+    """
+    previous = None
+    with open(results_file_name) as f:
+        for line in f:
+            recorded = json.loads(line)
+            if recorded['commit'] != run['commit']:
+                previous = recorded
+    return previous
+
+
+def compare_runs(run, previous):
+    """
+    A function that returns a table of the results of the given run next to the results of the previous run
+    """
+    previous_results = {}
+    if previous is not None:
+        previous_results = {(result['size'], result['orientation'], result['function']): result
+                            for result in previous['results']}
+    lines = ['%-8s %-22s %12s %12s %8s' % ('size', 'function', 'now', 'previous', 'ratio')]
+    for result in run['results']:
+        key = 'value' if 'value' in result else 'best_s'
+        old = previous_results.get((result['size'], result['orientation'], result['function']), {}).get(key)
+        lines.append('%-8s %-22s %12.4f %12s %8s' % (result['size'], result['function'], result[key],
+                                                     '-' if old is None else '%.4f' % old,
+                                                     '-' if not old else '%.2f' % (result[key] / old)))
+    if previous is not None:
+        lines.append('previous: commit %s from %s' % (previous['commit'], previous['date']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the public functions of ex3.py on synthetic phantoms')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(BENCHMARK_SIZES),
+                        help='sizes of the phantoms')
+    parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS, help='runs of every function')
+    parser.add_argument('--orientation', default='RPS', help='axis codes of the phantom files, e.g. RPS or LAS')
+    parser.add_argument('--data-dir', default=None, help='directory to keep the phantoms in')
+    parser.add_argument('--results', default=RESULTS_FILE_NAME, help='JSON lines file of the recorded runs')
+    parser.add_argument('--levels', nargs='*', type=int, default=[],
+                        help='numbers of resolutions of the region growing to compare')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeats, args.orientation, args.data_dir, args.levels)
+    run = record_results(results, args.results)
+    print(compare_runs(run, previous_run(run, args.results)))
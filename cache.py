@@ -0,0 +1,334 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import nibabel as nib
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'liver_segmentation')
+VOLUME_CACHE_MAX_BYTES = 20 * 2 ** 30
+STAGE_CACHE_MAX_BYTES = 2 * 2 ** 30
+HASH_CHUNK_SIZE = 2 ** 20
+COMPRESS_LEVEL = 1  # the gzip level of nib.save
+COMPRESS_CHUNK_SIZE = 2 ** 22  # bytes of a nifti file that are compressed into one gzip member by a single thread
+
+
+##############
+# USER GUIDE #
+##############
+# VolumeCache converts every nii.gz file it loads to an uncompressed .npy file the first time, and later loads of the
+# same file return a nifti image whose data is a read only np.memmap of that file, so the file is not decompressed
+# again. Pass a VolumeCache as volume_cache to segmentLiver or evaluateSegmentation in ex3.py, or call load_nifti
+# directly.
+# StageCache keeps the results of the stages before the region growing (IsolateBody, find_ROI and find_seeds with a
+# fixed seed), keyed by the content of their input files and their parameters. Pass a StageCache as stage_cache to
+# segmentLiver in ex3.py to reuse them between runs
+# PreloadedVolumes reads whole nifti files ahead of time and serves them like a VolumeCache, see the --prefetch option
+# of batch.py
+# save_nifti saves nifti images uncompressed ('.nii') or compressed with several threads ('.nii.gz'), with pigz if it is
+# installed
+# The cache directories can be deleted at any time
+
+
+class VolumeCache:
+    """
+    A class that keeps an on-disk cache of decompressed nifti volumes. The entries are keyed by the content hash of the
+    file, and the hash of every path is remembered together with the size and modification time of the file, so the
+    file is hashed again only when it changes. When the cache grows over max_bytes the least recently used entries are
+    removed
+    Several processes may share a cache: the index is read, modified and written, and the entries are opened, while an
+    exclusive lock of the cache directory is held (see file_lock), so an entry is never removed between the time a
+    process finds it and the time it maps its data. The decompression and the hashing of the files run without the lock
+    """
+
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'volumes'), max_bytes=VOLUME_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, 'index.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, file_name):
+        """
+        A function that loads the given nifti file through the cache
+        :return the function returns a nifti image of the same class, affine and header as nib.load would, whose data is
+        a read only np.memmap. The data is already scaled by the slope and intercept of the header
+        """
+        content_hash = self.file_hash(file_name)
+        data_path, meta_path = self._entry_paths(content_hash)
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            if content_hash in index['entries'] and os.path.exists(data_path) and os.path.exists(meta_path):
+                return self._open_entry(index, content_hash)
+
+        # the files of the entry are written to temporary files, and are moved into the cache with the lock held, so
+        # another process that evicts an older entry with the same hash can not remove them:
+        img = nib.load(file_name)
+        temp_data_path, temp_meta_path = temp_file_name(data_path), temp_file_name(meta_path)
+        with open(temp_data_path, 'wb') as f:
+            np.save(f, np.asanyarray(img.dataobj))
+        with open(temp_meta_path, 'wb') as f:
+            pickle.dump((img.__class__, img.affine, img.header), f)
+        with file_lock(self.lock_path):
+            os.replace(temp_data_path, data_path)
+            os.replace(temp_meta_path, meta_path)
+            index = self._read_index()
+            index['entries'][content_hash] = {'bytes': os.path.getsize(data_path) + os.path.getsize(meta_path)}
+            return self._open_entry(index, content_hash)
+
+    def file_hash(self, file_name):
+        """
+        A function that returns the content hash of the given file. The hash is taken from the index if the size and
+        modification time of the file did not change since it was computed
+        """
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        with file_lock(self.lock_path):
+            entry = self._read_index()['files'].get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash(path)}
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            index['files'][path] = entry
+            self._write_index(index)
+        return entry['hash']
+
+    def _open_entry(self, index, content_hash):
+        """
+        A function that marks the given entry as used, evicts other entries if the cache is too large and opens the
+        entry. It must be called with the lock held, and the index is written
+        """
+        index['entries'][content_hash]['last_access'] = time.time()
+        self._evict(index, keep=content_hash)
+        self._write_index(index)
+
+        data_path, meta_path = self._entry_paths(content_hash)
+        with open(meta_path, 'rb') as f:
+            img_class, affine, header = pickle.load(f)
+        return img_class(np.load(data_path, mmap_mode='r'), affine, header)
+
+    def _entry_paths(self, content_hash):
+        return (os.path.join(self.cache_dir, content_hash + '.npy'),
+                os.path.join(self.cache_dir, content_hash + '.meta'))
+
+    def _evict(self, index, keep):
+        """
+        A function that removes the least recently used entries until the cache is not larger than max_bytes. The entry
+        'keep' is never removed
+        """
+        entries = index['entries']
+        total_bytes = sum(entry['bytes'] for entry in entries.values())
+        for content_hash in sorted(entries, key=lambda h: entries[h].get('last_access', 0)):
+            if total_bytes <= self.max_bytes:
+                break
+            if content_hash == keep:
+                continue
+            for path in self._entry_paths(content_hash):
+                if os.path.exists(path):
+                    os.remove(path)
+            total_bytes -= entries.pop(content_hash)['bytes']
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {'files': {}, 'entries': {}}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        write_atomically(self.index_path, lambda f: f.write(json.dumps(index).encode()))
+
+
+class StageCache:
+    """
+    A class that keeps an on-disk cache of the results of deterministic stages of the pipeline. The key of a result is a
+    hash of the name of the stage, the content hashes of its inputs and its parameters, so a result is invalidated
+    automatically when an input or a parameter changes. Boolean masks are stored as packed bits. When the cache grows
+    over max_bytes the least recently used results are removed
+    Several processes may share a cache: every result is a single file that is written atomically, a result that is
+    removed by another process while it is read is a cache miss, and the eviction runs with an exclusive lock of the
+    cache directory (see file_lock)
+    """
+
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'stages'), max_bytes=STAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_path = os.path.join(cache_dir, 'evict.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, input_hashes, params):
+        """
+        A function that returns the key of the result of the given stage for the given input hashes and parameters. The
+        parameters must be JSON serializable
+        """
+        description = json.dumps([stage, list(input_hashes), params], sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        A function that returns the array that was stored with the given key, or None if there is none
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as stored:
+                if 'packed' in stored:
+                    shape = tuple(stored['shape'])
+                    data = np.unpackbits(stored['packed'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+                else:
+                    data = stored['data']
+            os.utime(path)  # the modification time of an entry is its last access time
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        A function that stores the given array with the given key, and evicts the least recently used results if the
+        cache is too large
+        """
+        data = np.asarray(data)
+        if data.dtype == bool:
+            write_atomically(self._path(key), lambda f: np.savez(f, packed=np.packbits(data), shape=data.shape))
+        else:
+            write_atomically(self._path(key), lambda f: np.savez(f, data=data))
+        self._evict(keep=key)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _evict(self, keep):
+        with file_lock(self.lock_path):
+            # (modification time, size, path) of every result, without the results that are removed meanwhile:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if path == self._path(keep):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+
+class PreloadedVolumes:
+    """
+    A class that reads the data of the given nifti files when it is created, and can be passed as volume_cache wherever
+    a VolumeCache is accepted, so the files can be read (e.g. in a background thread) before they are needed
+    """
+
+    def __init__(self, file_names, volume_cache=None):
+        """
+        :param file_names: The nifti files to read, whose images are returned by load
+        :param volume_cache: A VolumeCache to read the files through, or None to read them with nib.load
+        """
+        self.images = {}
+        for file_name in file_names:
+            img = load_nifti(file_name, volume_cache)
+            self.images[file_name] = img.__class__(np.asanyarray(img.dataobj), img.affine, img.header)
+
+    def load(self, file_name):
+        """
+        A function that returns the image of the given file, whose data was already read and scaled
+        """
+        return self.images[file_name]
+
+
+def load_nifti(file_name, volume_cache=None, keep_file_open=False):
+    """
+    A function that loads the given nifti file through the given VolumeCache, or with nib.load if it is None
+    :param keep_file_open: Passed to nib.load, if True a compressed file is kept open between reads of parts of its data
+    """
+    if volume_cache is None:
+        return nib.load(file_name, keep_file_open=keep_file_open)
+    return volume_cache.load(file_name)
+
+
+def save_nifti(img, file_name, compress_level=COMPRESS_LEVEL, threads=None):
+    """
+    A function that saves the given nifti image. A '.nii' file is written uncompressed. A '.nii.gz' file is compressed
+    with pigz if it is installed, and otherwise its chunks of COMPRESS_CHUNK_SIZE bytes are compressed in parallel into
+    consecutive gzip members, which gzip readers (nibabel, ITK-Snap) read as one file. The file is written atomically
+    :param compress_level: The gzip level, from 0 (fastest) to 9 (smallest)
+    :param threads: The number of compression threads, by default the number of CPUs
+    """
+    data = img.to_bytes()
+    if not file_name.endswith('.gz'):
+        write_atomically(file_name, lambda f: f.write(data))
+        return
+    threads = threads or os.cpu_count() or 1
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        write_atomically(file_name, lambda f: subprocess.run([pigz, '-%d' % compress_level, '-p', str(threads), '-c'],
+                                                             input=data, stdout=f, check=True))
+        return
+    view = memoryview(data)
+    chunks = [view[start:start + COMPRESS_CHUNK_SIZE] for start in range(0, len(data), COMPRESS_CHUNK_SIZE)]
+    with ThreadPoolExecutor(threads) as executor:
+        members = list(executor.map(lambda chunk: gzip.compress(chunk, compress_level, mtime=0), chunks))
+    write_atomically(file_name, lambda f: f.writelines(members))
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    A context manager that holds an exclusive lock of the given lock file, which is created if it does not exist. The
+    lock is shared between processes (and between the threads of a process, which open the file separately)
+    """
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def content_hash(file_name):
+    """
+    A function that returns the sha256 hex digest of the content of the given file
+    """
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_atomically(file_name, write):
+    """
+    A function that calls write with a binary file object of a temporary file, and then moves it to file_name, so
+    concurrent readers never see a partially written file
+    """
+    temp_name = temp_file_name(file_name)
+    with open(temp_name, 'wb') as f:
+        write(f)
+    os.replace(temp_name, file_name)
+
+
+def temp_file_name(file_name):
+    """
+    A function that returns the name of a temporary file next to the given file, unique to the current thread
+    """
+    return '%s.%d.%d.tmp' % (file_name, os.getpid(), threading.get_ident())
+
@@ -0,0 +1,249 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+from skimage import morphology
+
+from benchmark import make_phantom, phantom_params
+from ex3 import (GROWING_TOLERANCE, SURFACE_TOLERANCE, OccupancyIndex, PipelineContext, aorta_mid_slice, dilate_disk,
+                 evaluateSegmentation, fill_small_holes, find_surface, keep_largest_component_slabs,
+                 keep_largest_components, min_dist, region_growing, segmentLiver, surface_metrics)
+
+CHECK_CASES = 50
+GAP_PHANTOM_SHAPE = (128, 128, 24)
+GAP_MIN_DICE = 0.95
+BOX_PHANTOM_SHAPE = (48, 40, 12)
+BOX_ORIENTATIONS = ('RPS', 'LPS', 'RAS', 'LAI')
+
+
+##############
+# USER GUIDE #
+##############
+# Checks that the fast implementations in ex3.py give exactly the same results as the straightforward implementations
+# they replaced (e.g. min_dist for the surface distances), on random volumes:
+#     python checks.py --cases 50 --seed 0
+#     python checks.py region_growing
+# Every check prints the number of cases whose results differ, and the script fails if any check has a mismatch. The
+# aorta_gap check segments a phantom (see benchmark.py) whose aorta segmentation has a gap of empty slices around its
+# middle slice, and fails if segmentLiver raises or its dice coefficient is lower than GAP_MIN_DICE. The ct_box check
+# reads random boxes of phantoms in random orientations in the streaming mode, and fails if a box differs from the box
+# of the loaded CT or keeps a larger array alive
+
+
+def random_volume(rng, max_shape=(40, 40, 12)):
+    """
+    A function that returns a random smooth integer volume in HU, whose regions of similar values have random shapes
+    """
+    shape = tuple(int(rng.integers(4, size + 1)) for size in max_shape)
+    volume = ndimage.gaussian_filter(rng.normal(0, 60, shape), rng.uniform(0.5, 2))
+    return np.round(volume * 4).astype(np.int16)
+
+
+def reference_region_growing(ct_data, seeds_data, tolerance=GROWING_TOLERANCE):
+    """
+    A function that grows a region by dilating the whole region with a 3x3x3 cube in every iteration and accepting
+    the new voxels within tolerance of the mean of the region, until no voxel is added, as the original algorithm did
+    """
+    cube = np.ones((3, 3, 3), dtype=bool)
+    region = seeds_data != 0
+    while True:
+        region_mean = np.mean(ct_data[region])
+        neighbors = ndimage.binary_dilation(region, cube) & ~region
+        accepted = neighbors & (np.abs(ct_data - region_mean) <= tolerance)
+        if not accepted.any():
+            return region
+        region |= accepted
+
+
+def check_region_growing(rng):
+    """
+    A function that checks region_growing (with exact=True, with and without chunks) against
+    reference_region_growing on a random volume with random seeds
+    :return the function returns True if the results are the same
+    """
+    ct_data = random_volume(rng)
+    seeds_data = rng.random(ct_data.shape) < rng.uniform(0.001, 0.02)
+    seeds_data.flat[rng.integers(ct_data.size)] = True
+    expected = reference_region_growing(ct_data, seeds_data)
+    return (np.array_equal(region_growing(ct_data, seeds_data), expected) and
+            np.array_equal(region_growing(ct_data, seeds_data, chunk_size=7), expected))
+
+
+def check_component_slabs(rng):
+    """
+    A function that checks keep_largest_component_slabs with a random slab size against keep_largest_components, which
+    labels the whole mask at once, on a random mask. If the k-th and the (k+1)-th largest components have the same
+    size, either of them may be kept, and only the number of kept voxels is compared
+    :return the function returns True if the results are the same
+    """
+    mask = random_volume(rng, (30, 30, 40)) > rng.uniform(-20, 60)
+    k = int(rng.integers(1, 4))
+    expected = keep_largest_components(mask, k)
+    result = keep_largest_component_slabs(lambda start, stop: mask[:, :, start:stop], mask.shape,
+                                          int(rng.integers(1, 10)), k)
+    if np.array_equal(result, expected):
+        return True
+    labels, _ = ndimage.label(mask, ndimage.generate_binary_structure(3, 3))
+    sizes = np.sort(np.bincount(labels.ravel())[1:])[::-1]
+    tie = sizes.size > k and sizes[k - 1] == sizes[k]
+    return tie and result.sum() == expected.sum()
+
+
+def reference_aorta_mid_slice(aorta_data):
+    """
+    A function that returns the middle of the borders of the aorta along the third axis, or the nearest slice that
+    contains the aorta if the middle slice is empty, by looking at the slices below and above it one by one
+    """
+    aorta_slices = np.flatnonzero(aorta_data.any(axis=(0, 1)))
+    aorta_mid = int((aorta_slices[0] + aorta_slices[-1] + 1) / 2)
+    for distance in range(aorta_data.shape[2]):
+        for slc in (aorta_mid - distance, aorta_mid + distance):
+            if 0 <= slc < aorta_data.shape[2] and aorta_data[:, :, slc].any():
+                return slc
+
+
+def check_aorta_gap(rng):
+    """
+    A function that removes 1 to 3 slices around the middle of the aorta of a phantom, and checks aorta_mid_slice
+    against reference_aorta_mid_slice and that segmentLiver still segments the liver of the phantom
+    :return the function returns True if the checks pass
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        ct_file_name, aorta_file_name, liver_file_name = make_phantom(directory, GAP_PHANTOM_SHAPE,
+                                                                      seed=int(rng.integers(2 ** 31)))
+        aorta_img = nib.load(aorta_file_name)
+        aorta_data = np.asanyarray(aorta_img.dataobj).copy()
+        aorta_slices = np.flatnonzero(aorta_data.any(axis=(0, 1)))
+        gap_start = (aorta_slices[0] + aorta_slices[-1] + 1) // 2 - int(rng.integers(0, 3))
+        aorta_data[:, :, gap_start:gap_start + int(rng.integers(1, 4))] = 0
+        gap_file_name = os.path.join(directory, 'gap_Aorta.nii.gz')
+        nib.save(nib.Nifti1Image(aorta_data, aorta_img.affine, aorta_img.header), gap_file_name)
+
+        if aorta_mid_slice(OccupancyIndex(aorta_data)) != reference_aorta_mid_slice(aorta_data):
+            return False
+        try:
+            output_file_name = segmentLiver(ct_file_name, gap_file_name, os.path.join(directory, 'liver'),
+                                            rng=int(rng.integers(2 ** 31)), params=phantom_params(GAP_PHANTOM_SHAPE))
+        except Exception:
+            return False
+        return evaluateSegmentation(liver_file_name, output_file_name).dice_coefficient >= GAP_MIN_DICE
+
+
+def check_ct_box(rng):
+    """
+    A function that checks PipelineContext.ct_box in the streaming mode against the box of the loaded CT, on a phantom
+    in a random orientation, and that the returned box does not keep a larger array alive
+    :return the function returns True if the checks pass
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        orientation = BOX_ORIENTATIONS[rng.integers(len(BOX_ORIENTATIONS))]
+        ct_file_name, _, _ = make_phantom(directory, BOX_PHANTOM_SHAPE, orientation, seed=int(rng.integers(2 ** 31)))
+        box = []
+        for size in BOX_PHANTOM_SHAPE:
+            start = int(rng.integers(size))
+            box.append(slice(start, int(rng.integers(start + 1, size + 1))))
+        box = tuple(box)
+        data = PipelineContext(ct_file_name, slab_size=4).ct_box(box)
+        expected = PipelineContext(ct_file_name).ct_data[box]
+        base = data if data.base is None else data.base
+        return np.array_equal(data, expected) and base.shape == expected.shape
+
+
+def check_surface_distances(rng):
+    """
+    A function that checks surface_metrics, which measures the distances between the surfaces with distance transforms,
+    against the distances of every surface voxel from the other surface computed by min_dist, on two random masks with
+    a random anisotropic spacing
+    :return the function returns True if all the metrics are the same
+    """
+    volume = random_volume(rng, (30, 30, 12))
+    true_data = volume > rng.uniform(-20, 20)
+    est_data = volume + rng.normal(0, 20, volume.shape) > rng.uniform(-20, 20)
+    true_data.flat[rng.integers(true_data.size)] = est_data.flat[rng.integers(est_data.size)] = True
+    spacing = rng.uniform(0.5, 3, 3)
+
+    pixdim = np.concatenate([[1], spacing])
+    true_points, est_points = np.argwhere(find_surface(true_data)), np.argwhere(find_surface(est_data))
+    true_distances = np.array([min_dist(point, est_points, pixdim) for point in true_points])
+    est_distances = np.array([min_dist(point, true_points, pixdim) for point in est_points])
+    expected = [(true_distances.mean() + est_distances.mean()) / 2, max(true_distances.max(), est_distances.max()),
+                max(np.percentile(true_distances, 95), np.percentile(est_distances, 95)),
+                (np.count_nonzero(true_distances <= SURFACE_TOLERANCE) +
+                 np.count_nonzero(est_distances <= SURFACE_TOLERANCE)) / (true_points.shape[0] + est_points.shape[0])]
+    metrics = surface_metrics(true_data, est_data, spacing)
+    result = [metrics.ASSD, metrics.hausdorff, metrics.hausdorff_95, metrics.surface_dice]
+    return np.allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+
+def disk_footprint(radius, spacing):
+    """
+    A function that returns the footprint of a disk of the given radius (in the units of the spacing) as a boolean
+    array, like morphology.disk(radius) when the spacing is 1
+    """
+    half_size = [int(radius // step) for step in spacing]
+    offsets = np.ogrid[tuple(slice(-size, size + 1) for size in half_size)]
+    return sum((offset * step) ** 2 for offset, step in zip(offsets, spacing)) <= radius ** 2
+
+
+def check_disk_morphology(rng):
+    """
+    A function that checks dilate_disk, which thresholds a distance transform, against the dilation of a random mask
+    with the footprint of the disk, with an integer radius in voxels and with a random radius and anisotropic spacing
+    :return the function returns True if the results are the same
+    """
+    mask = random_volume(rng, (60, 60, 4))[:, :, 0] > rng.uniform(0, 80)
+    mask.flat[rng.integers(mask.size)] = True
+    radius = int(rng.integers(1, 12))
+    if not np.array_equal(dilate_disk(mask, radius), ndimage.binary_dilation(mask, disk_footprint(radius, (1, 1)))):
+        return False
+    radius, spacing = rng.uniform(0.5, 12), rng.uniform(0.5, 2, 2)
+    return np.array_equal(dilate_disk(mask, radius, spacing),
+                          ndimage.binary_dilation(mask, disk_footprint(radius, spacing)))
+
+
+def check_small_holes(rng):
+    """
+    A function that checks fill_small_holes, which labels the background of all the slices at once, against
+    morphology.remove_small_holes of every slice, on a random stack of slices along a random axis
+    :return the function returns True if the results are the same
+    """
+    mask = random_volume(rng, (40, 40, 12)) > rng.uniform(-40, 20)
+    max_size, axis = int(rng.integers(1, 80)), int(rng.integers(3))
+    expected = np.stack([morphology.remove_small_holes(np.take(mask, slc, axis), max_size=max_size)
+                         for slc in range(mask.shape[axis])], axis)
+    return np.array_equal(fill_small_holes(mask, max_size, axis), expected)
+
+
+CHECKS = {'region_growing': check_region_growing, 'component_slabs': check_component_slabs,
+          'aorta_gap': check_aorta_gap, 'ct_box': check_ct_box, 'surface_distances': check_surface_distances,
+          'disk_morphology': check_disk_morphology, 'small_holes': check_small_holes}
+
+
+def run_checks(names, cases=CHECK_CASES, seed=0):
+    """
+    A function that runs the given checks on the given number of random cases
+    :return the function returns a dict from the name of every check to the number of cases with a mismatch
+    """
+    mismatches = {}
+    for name in names:
+        rng = np.random.default_rng(seed)
+        mismatches[name] = sum(not CHECKS[name](rng) for _ in range(cases))
+        print('%-36s %4d cases %4d mismatches' % (name, cases, mismatches[name]))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fast implementations of ex3.py against reference ones')
+    parser.add_argument('checks', nargs='*', help='checks to run, all of them by default: %s' % ', '.join(CHECKS))
+    parser.add_argument('--cases', type=int, default=CHECK_CASES, help='random cases of every check')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random cases')
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error('unknown checks: %s' % ', '.join(sorted(unknown)))
+
+    sys.exit(1 if any(run_checks(args.checks or list(CHECKS), args.cases, args.seed).values()) else 0)
@@ -1,13 +1,55 @@
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, asdict
+from typing import Optional
+
 import nibabel as nib
 import numpy as np
-from skimage import measure, morphology
-from scipy.signal import convolve2d
-import copy
+from scipy import ndimage
+
+from cache import COMPRESS_LEVEL, content_hash, load_nifti, save_nifti
 
+BODY_MIN_TH = -500
+BODY_MAX_TH = 2000
+SKIN_RADIUS = 60
 SEEDS_NUM = 200
+SEED_OFFSET = 50
+STRATA_GRID = 4
 LIVER_MIN_TH = -100
 LIVER_MAX_TH = 200
 GROWING_REPS = 150
+GROWING_TOLERANCE = 20
+GROWING_SIGMA_FACTOR = 2.5
+GROWING_LEVELS = 1  # resolutions of the region growing, 1 grows only at the full resolution
+GROWING_PYRAMID_FACTORS = (2, 2, 1)  # downsampling of every level of the pyramid, the slices are usually thick already
+GROWING_BAND_WIDTH = 3  # voxels around the upsampled boundary that are grown again at the finer resolution
+CROP_PADDING = 2
+HOLE_MAX_SIZE = 64  # holes of a slice of at most this many pixels are filled by the post processing
+POST_PROCESSING_MODES = ('slice_chain', '3d')
+SURFACE_TOLERANCE = 2.0  # mm
+SURFACE_CACHE_SIZE = 16
+STAGE_CACHE_VERSION = 2  # part of every stage cache key, increased whenever the algorithm of a cached stage changes
+
+# the rank of the structuring element of find_surface for every (dimension, connectivity) pair:
+SURFACE_CONNECTIVITY = {(2, 4): 1, (2, 8): 2, (3, 6): 1, (3, 18): 2, (3, 26): 3}
+
+# bytes per voxel that the stages allocate, used to check the memory budget before a stage runs:
+BODY_BYTES_PER_VOXEL = 6  # threshold mask, int32 labels and the kept mask
+GROWING_BYTES_PER_VOXEL = 3  # seeds, region and visited masks
+NEIGHBOR_BYTES = 26 * 3 * 8 * 2  # neighbour coordinates of one frontier voxel and their flat indexes
+GROWING_FRONTIER_FRACTION = 0.1  # estimated largest frontier, as a fraction of the cropped volume
+GROWING_CHUNK_SIZE = 2 ** 16  # frontier voxels whose neighbours are computed at once in the low memory mode
+POST_PROCESSING_BYTES_PER_VOXEL = 6  # int32 labels, the filled and the kept masks of the whole stack of slices
+STREAMING_SLAB_SIZE = 32  # slices of a slab when isolate_body switches to the streaming mode to fit a memory budget
+
+# offsets of the 26-connected neighbours of a voxel, as a 3x26 array:
+NEIGHBOR_OFFSETS = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+                             if (i, j, k) != (0, 0, 0)]).T
 
 
 ##############
@@ -16,85 +58,709 @@ GROWING_REPS = 150
 # All functions expect to get a path to the nii.gz file they are supposed to receive.
 # Please provide either a full path or put the nii.gz files in the same directory as the ex3.py file for the functions
 # to read the files properly
-# During the run of this program several nii.gz files are being saved and loaded in a later step of the program, please
-# notice that all files must be saved in the same location as the ex3.py file
-# Moreover, there are several nii.gz files that can be saved by uncommenting the #UNCOMMENT# comments in the code, this
-# might be used in order to examine the performance of the code using ITK-Snap
+# segmentLiver loads the CT and aorta files only once into a PipelineContext and passes the volumes between the steps
+# of the algorithm in memory. The stage functions (IsolateBody, find_ROI, find_seeds, multipleSeedsRG) accept either a
+# path to the CT file or a PipelineContext
+# Several intermediate nii.gz files (body segmentation, ROI, seeds and region growing result) can be saved by passing
+# save_debug=True to segmentLiver, this might be used in order to examine the performance of the code using ITK-Snap.
+# These files are saved in the same location as the CT file, or in debug_dir if it is given
+# All the masks of the pipeline are boolean volumes. Passing a memory_budget (in bytes, or a MemoryBudget) to
+# segmentLiver measures the peak memory of every stage (see MemoryBudget.report), and switches the stages to lower
+# memory strategies or fails fast with MemoryBudgetExceeded when a stage would exceed the budget
+# Passing a cache.VolumeCache as volume_cache to segmentLiver or evaluateSegmentation loads the nii.gz files through an
+# on-disk cache of decompressed volumes, so repeated runs on the same files do not decompress them again
+# Passing a cache.StageCache as stage_cache to segmentLiver reuses the results of IsolateBody, find_ROI and find_seeds
+# (when rng is an int seed) from previous runs with the same input files and parameters. STAGE_CACHE_VERSION is part of
+# the keys, so results of older versions of the stages are not reused
+# The parameters of the algorithm can be changed by passing a SegmentationParams as params to segmentLiver, and
+# sweep.py searches a grid of parameters for the best segmentation of a set of cases
+# The stages do not print their progress. Passing a Tracer as tracer to segmentLiver records the wall time, CPU time and
+# peak memory of every stage and the frontier size and region mean of every iteration of the region growing, which
+# can be exported with tracer.to_json(file_name) or printed with tracer.summary(). Without a tracer nothing is recorded
+# Passing slab_size to segmentLiver runs it in the streaming mode: the CT is read from the nifti file in slabs of
+# slab_size slices, the body is found slab by slab (see keep_largest_component_slabs) and the post processing runs
+# slab by slab, so only the sub-volume of the CT around the body is loaded and no full size labels are allocated
+# SegmentationParams(growing_levels=2) or more grows the region coarse to fine (see multiresolution_region_growing),
+# which is faster on large scans. 'python benchmark.py --levels 1 2 3' reports its speed and accuracy
+# SegmentationParams(post_processing='3d') replaces the post processing of the slices (filling their small holes,
+# keeping their largest components and removing the slices that do not intersect the chain of slices around the
+# middle slice of the aorta) with a 3D one: the cavities of the volume are filled and only the 3D component of the
+# middle slice of the aorta is kept (see keep_anchored_component). The default is 'slice_chain', the post processing
+# of the slices
+# The segmentation and the intermediate volumes are saved as uint8 '.nii.gz' files with the affine of the CT. Passing an
+# OutputFormat as output_format to segmentLiver changes their data type, gzip level and number of compression threads,
+# or saves them uncompressed as '.nii' files, which is the fastest when the disk is not the bottleneck
+# service.py runs segmentLiver and evaluateSegmentation as jobs of a long lived service with warm worker processes,
+# which saves the start up time of many small runs
 # main function can be activated in the end of this file to run the code
 
-def segmentLiver(ctFileName, AortaFileName, outputFileName):
+
+# surfaces that were already extracted by cached_surface_points, the oldest is removed first:
+_surface_cache = OrderedDict()
+
+
+@dataclass(frozen=True)
+class SegmentationParams:
     """
-    A function that receives the names of the aorta and CT files it should use, and segments the liver in the original CT
-    The function saves a segmentation file called 'outputFileName'
+    The tunable parameters of the segmentation of the liver. The defaults are the module constants
     """
-    file_name = ctFileName.split('.')[0]
+    seeds_num: int = SEEDS_NUM
+    seed_offset: int = SEED_OFFSET
+    stratified_seeds: bool = False  # if True, the seeds are spread over a grid of cells of the ROI, see find_seeds
+    liver_min_th: float = LIVER_MIN_TH
+    liver_max_th: float = LIVER_MAX_TH
+    growing_tolerance: float = GROWING_TOLERANCE
+    growing_criterion: str = 'window'  # the acceptance criterion of the region growing, 'window' or 'sigma'
+    growing_sigma_factor: float = GROWING_SIGMA_FACTOR
+    growing_exact: bool = True  # if False, every voxel is examined only once by the region growing, see region_growing
+    growing_levels: int = GROWING_LEVELS
+    skin_radius: int = SKIN_RADIUS
+    skin_radius_mm: Optional[float] = None  # if given, the skin radius in mm, which replaces skin_radius
+    post_processing: str = 'slice_chain'  # one of POST_PROCESSING_MODES, see segment_context
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """
+    The format of the saved segmentations, see cache.save_nifti
+    """
+    dtype: str = 'uint8'
+    compressed: bool = True
+    compress_level: int = COMPRESS_LEVEL
+    threads: Optional[int] = None  # compression threads, by default the number of CPUs
 
-    # todo: delete this 4 lines
-    ct_img = nib.load(ctFileName)
-    print(nib.aff2axcodes(ct_img.affine))
-    orientation_flags = img_orientation(ctFileName)
-    print(orientation_flags)
-
-    ROI_segmentation = find_ROI(ctFileName, AortaFileName, orientation_flags)
-    multipleSeedsRG(ctFileName, ROI_segmentation, orientation_flags)
-
-    ct_scan = nib.load(file_name + '_region_growing.nii.gz')
-    ct_data = ct_scan.get_data()
-    if orientation_flags.any():
-        ct_data = flip_axis(ct_data, orientation_flags)
-
-    # perform morphological operation on the liver segmentation that was createdÖ
-    for slc in range(ct_scan.shape[2]):
-        if ct_data[:, :, slc].any():
-            ct_data[:, :, slc] = morphology.remove_small_holes(ct_data[:, :, slc].astype(np.uint8))
-            ct_data[:, :, slc], connected_components_num = measure.label(ct_data[:, :, slc], return_num=True)
-            props = measure.regionprops(ct_data[:, :, slc].astype(np.uint16), coordinates='rc')
-            area_list = [region.area for region in props]
-            ct_data[:, :, slc] = morphology.remove_small_objects(ct_data[:, :, slc].astype(np.uint8),
-                                                                 min_size=max(area_list))
-    ct_data[ct_data != 0] = 1
-    for slc in range(ct_scan.shape[2]):
-        if ct_data[:, :, slc].any():
-            ct_data[:, :, slc], connected_components_num = measure.label(ct_data[:, :, slc], return_num=True)
-            props = measure.regionprops(ct_data[:, :, slc].astype(np.uint16), coordinates='rc')
-            area_list = [region.area for region in props]
-            ct_data[:, :, slc] = morphology.remove_small_objects(ct_data[:, :, slc].astype(np.uint8),
-                                                                 min_size=max(area_list))
-
-    ct_data[ct_data != 0] = 1
-
-    # remove over-segmentation slices:
-    ct_data = remove_over_segmentation(ct_data, AortaFileName)
-
-    # save the segmentation of the liver as a nifti file
-    nib.save(ct_scan, outputFileName + '.nii.gz')
-
-
-def evaluateSegmentation(ground_truth_segmentation, estimated_segmentation):
+    @property
+    def extension(self):
+        return '.nii.gz' if self.compressed else '.nii'
+
+
+class PipelineContext:
+    """
+    A class that holds the volumes of a single run of the algorithm, so that every file is loaded and decompressed only
+    once and the axes are flipped only once. All the volumes in the context are kept in the flipped ('R,P,S')
+    orientation
+    """
+
+    def __init__(self, ctFileName, AortaFileName=None, save_debug=False, memory_budget=None, volume_cache=None,
+                 stage_cache=None, debug_dir=None, tracer=None, slab_size=None, output_format=None, image_writer=None):
+        """
+        :param ctFileName: The path to the CT scan
+        :param AortaFileName: The path to the segmentation of the aorta, may be None for stages that do not use it
+        :param save_debug: If True, the intermediate segmentations are saved as nii.gz files for ITK-Snap
+        :param memory_budget: A MemoryBudget that measures and limits the memory of the stages, or None
+        :param volume_cache: A cache.VolumeCache to load the files through, or None to load them directly. The volumes
+        of a cache are read only memory maps
+        :param stage_cache: A cache.StageCache for the results of the deterministic stages, or None
+        :param debug_dir: The directory of the intermediate nii.gz files, by default the directory of the CT file
+        :param tracer: A Tracer that records the time and memory of the stages, or None
+        :param slab_size: If given, the CT is not loaded at once, the stages read it in slabs of slab_size slices
+        :param output_format: The OutputFormat of the saved volumes, by default uint8 '.nii.gz' files
+        :param image_writer: A function that saves a nifti image as the given file name (e.g. BackgroundWriter.write of
+        batch.py), by default cache.save_nifti with the gzip level and threads of output_format
+        """
+        self.ct_file_name = ctFileName
+        self.aorta_file_name = AortaFileName
+        self.file_name = ctFileName.split('.nii')[0]
+        if debug_dir is not None:
+            self.file_name = os.path.join(debug_dir, os.path.basename(self.file_name))
+        self.save_debug = save_debug
+        self.memory_budget = memory_budget
+        self.volume_cache = volume_cache
+        self.stage_cache = stage_cache
+        self.tracer = tracer
+        self.slab_size = slab_size
+        self.output_format = output_format or OutputFormat()
+        self.image_writer = image_writer
+        self._file_hashes = {}
+
+        with self.stage('load'):
+            # in the streaming mode the file is kept open, so reading consecutive slabs does not decompress it again:
+            self.ct_img = load_nifti(ctFileName, volume_cache, keep_file_open=slab_size is not None)
+            self.shape = self.ct_img.shape
+            ct_data = np.asanyarray(self.ct_img.dataobj) if slab_size is None else None
+            aorta_data = None
+            if AortaFileName is not None:
+                aorta_data = np.asanyarray(load_nifti(AortaFileName, volume_cache).dataobj)
+
+        with self.stage('orientation'):
+            self.orientation_flags = orientation_from_affine(self.ct_img.affine)
+            self._ct_data = flip_axis(ct_data, self.orientation_flags) if ct_data is not None else None
+            self.aorta_data = None
+            if aorta_data is not None:
+                self.aorta_data = flip_axis(aorta_data, self.orientation_flags)
+
+        # results of the stages that are shared by several other stages:
+        self.body_data = None
+        self.roi_data = {}  # ROI segmentations by the skin radii (in voxels and in mm) they were found with
+        self._body_index = None
+        self._aorta_index = None
+
+    @property
+    def ct_data(self):
+        """
+        The whole CT, which is loaded on the first access in the streaming mode
+        """
+        if self._ct_data is None:
+            with self.stage('load_ct'):
+                self._ct_data = flip_axis(np.asanyarray(self.ct_img.dataobj), self.orientation_flags)
+        return self._ct_data
+
+    def ct_slab(self, start, stop):
+        """
+        A function that returns the slices [start, stop) of the CT along the third axis. If the CT is not loaded, only
+        these slices are read from the file
+        """
+        if self._ct_data is not None:
+            return self._ct_data[:, :, start:stop]
+        file_slice = self.file_slice(slice(start, stop), 2)
+        return flip_axis(np.asanyarray(self.ct_img.dataobj[:, :, file_slice]), self.orientation_flags)
+
+    def ct_box(self, box):
+        """
+        A function that returns the sub-volume of the CT inside the given box. If the CT is not loaded, only the box is
+        read from the file, and the returned volume is a copy that does not keep the rest of the read slices alive
+        """
+        if self._ct_data is not None:
+            return self._ct_data[box]
+        file_box = tuple(self.file_slice(box[axis], axis) for axis in range(3))
+        # nibabel reads whole rows along the first axis and returns a view of them:
+        return flip_axis(np.asanyarray(self.ct_img.dataobj[file_box]), self.orientation_flags).copy()
+
+    def file_slice(self, slc, axis):
+        """
+        A function that maps the given slice of the flipped volumes along the given axis to the same voxels in the
+        original orientation of the file
+        """
+        start, stop = slc.start or 0, self.shape[axis] if slc.stop is None else slc.stop
+        if self.orientation_flags[axis]:
+            start, stop = self.shape[axis] - stop, self.shape[axis] - start
+        return slice(start, stop)
+
+    @property
+    def body_index(self):
+        """
+        The OccupancyIndex of the body segmentation
+        """
+        if self._body_index is None:
+            self._body_index = OccupancyIndex(IsolateBody(self))
+        return self._body_index
+
+    @property
+    def aorta_index(self):
+        """
+        The OccupancyIndex of the aorta segmentation
+        """
+        if self._aorta_index is None:
+            self._aorta_index = OccupancyIndex(self.aorta_data)
+        return self._aorta_index
+
+    @property
+    def crop_box(self):
+        """
+        The padded bounding box of the body segmentation. The liver lies inside the body, so the heavy stages only
+        process this sub-volume of the CT
+        """
+        return self.body_index.bounding_box(CROP_PADDING)
+
+    @property
+    def affine(self):
+        return self.ct_img.affine
+
+    @property
+    def header(self):
+        return self.ct_img.header
+
+    def stage(self, name):
+        """
+        A function that returns a context manager that measures the given stage, see Tracer.stage and
+        MemoryBudget.stage. Without a tracer and a memory budget nothing is measured
+        """
+        if self.tracer is not None:
+            return self.tracer.stage(name, self.memory_budget)
+        if self.memory_budget is None:
+            return nullcontext()
+        return self.memory_budget.stage(name)
+
+    def memory_allows(self, name, estimated_bytes):
+        """
+        A function that checks whether the given stage may allocate the given number of bytes, see MemoryBudget.allows
+        """
+        if self.memory_budget is None:
+            return True
+        return self.memory_budget.allows(name, estimated_bytes)
+
+    def file_hash(self, file_name):
+        """
+        A function that returns the content hash of the given input file, computed once per context
+        """
+        if file_name not in self._file_hashes:
+            if self.volume_cache is not None:
+                self._file_hashes[file_name] = self.volume_cache.file_hash(file_name)
+            else:
+                self._file_hashes[file_name] = content_hash(file_name)
+        return self._file_hashes[file_name]
+
+    def stage_key(self, name, params, uses_aorta=False, input_hashes=()):
+        """
+        A function that returns the key of the result of the given stage in the stage cache, or None if there is no
+        stage cache. The key depends on the content of the CT file (and of the aorta file if uses_aorta), on the
+        given hashes of other inputs, on the given parameters and on STAGE_CACHE_VERSION
+        """
+        if self.stage_cache is None:
+            return None
+        input_hashes = [self.file_hash(self.ct_file_name)] + list(input_hashes)
+        if uses_aorta:
+            input_hashes.append(self.file_hash(self.aorta_file_name))
+        return self.stage_cache.key(name, input_hashes, dict(params, version=STAGE_CACHE_VERSION))
+
+    def load_stage(self, key):
+        """
+        A function that returns the cached result with the given key, or None if the key is None or not in the cache
+        """
+        if key is None:
+            return None
+        return self.stage_cache.get(key)
+
+    def store_stage(self, key, data):
+        """
+        A function that stores the result of a stage in the stage cache, if the key is not None
+        """
+        if key is not None:
+            self.stage_cache.put(key, data)
+
+    def to_image(self, data):
+        """
+        A function that flips the given volume back to the original orientation of the CT and wraps it in a nifti image
+        with the affine of the CT. The data is converted to the data type of the OutputFormat of the context, so a mask
+        is saved without scaling
+        """
+        dtype = self.output_format.dtype
+        img = nib.Nifti1Image(flip_axis(data, self.orientation_flags).astype(dtype, copy=False), self.affine,
+                              self.header)
+        img.set_data_dtype(dtype)
+        return img
+
+    def save_volume(self, data, file_name):
+        """
+        A function that saves the given volume as '<file_name><extension>' in the OutputFormat of the context, with its
+        image_writer if it has one
+        :return the function returns the name of the saved file
+        """
+        file_name += self.output_format.extension
+        img = self.to_image(data)
+        if self.image_writer is not None:
+            self.image_writer(img, file_name)
+        else:
+            save_nifti(img, file_name, self.output_format.compress_level, self.output_format.threads)
+        return file_name
+
+    def save_debug_volume(self, data, suffix):
+        """
+        A function that saves the given intermediate volume as '<file_name><suffix>' with the extension of the
+        OutputFormat (see save_volume) if debug saving is enabled
+        """
+        if self.save_debug:
+            self.save_volume(data, self.file_name + suffix)
+
+
+class OccupancyIndex:
+    """
+    A class that summarizes where a 3D mask is non zero. The projections of every axial slice on the first two axes and
+    the number of voxels in every slice are computed once, and the borders of the mask along every axis and the borders
+    of every slice are answered from them without scanning the mask again. Empty slices inside the mask (gaps) do not
+    cut the borders
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask) != 0
+        self.shape = mask.shape
+        self.slice_counts = np.count_nonzero(mask, axis=(0, 1))
+        # the projection of every slice on axis 0 and on axis 1, as (shape[0], Z) and (shape[1], Z) arrays:
+        self._slice_projections = (mask.any(axis=1), mask.any(axis=0))
+
+    def nonzero_flags(self, axis):
+        """
+        A function that returns a boolean array with a flag for every index along the given axis, which is True if the
+        mask has a non zero voxel at this index
+        """
+        if axis == 2:
+            return self.slice_counts > 0
+        return self._slice_projections[axis].any(axis=1)
+
+    def axis_range(self, axis):
+        """
+        A function that returns the borders (start, stop) of the mask along the given axis, or None if the mask is empty
+        """
+        return flags_range(self.nonzero_flags(axis))
+
+    def slice_ranges(self, slc):
+        """
+        A function that returns the borders of the given axial slice of the mask along axis 0 and axis 1, as two
+        (start, stop) pairs, or None instead of a pair if the slice is empty
+        """
+        return (flags_range(self._slice_projections[0][:, slc]),
+                flags_range(self._slice_projections[1][:, slc]))
+
+    def bounding_box(self, padding=0):
+        """
+        A function that returns the bounding box of the mask as a tuple of slices, see bounding_box
+        """
+        box = []
+        for axis in range(3):
+            axis_range = self.axis_range(axis)
+            if axis_range is None:
+                return (slice(0, 0),) * 3
+            box.append(slice(max(axis_range[0] - padding, 0), min(axis_range[1] + padding, self.shape[axis])))
+        return tuple(box)
+
+
+def flags_range(flags):
+    """
+    A function that returns the borders (start, stop) of the True values in the given 1D array, or None if there are
+    none
+    """
+    nonzero = np.flatnonzero(flags)
+    if not nonzero.size:
+        return None
+    return int(nonzero[0]), int(nonzero[-1]) + 1
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """
+    Raised when a stage of the pipeline would exceed the memory budget and has no lower memory strategy
+    """
+
+
+class MemoryBudget:
+    """
+    A class that measures the peak memory of every stage of the pipeline with tracemalloc (numpy reports its
+    allocations to it), and checks the estimated memory of a stage against a limit before the stage allocates it
+    """
+
+    def __init__(self, limit=None, on_exceed='degrade'):
+        """
+        :param limit: The memory limit in bytes, or None to only measure the stages
+        :param on_exceed: 'degrade' to switch a stage that would exceed the limit to a lower memory strategy when it has
+        one, or 'raise' to always fail fast with MemoryBudgetExceeded
+        """
+        if on_exceed not in ('degrade', 'raise'):
+            raise ValueError("on_exceed must be 'degrade' or 'raise', got %r" % (on_exceed,))
+        self.limit = limit
+        self.on_exceed = on_exceed
+        self.stage_peaks = OrderedDict()
+        self.degraded_stages = []
+        self._open_stages = []  # [name, peak] of the stages that are running, the innermost is last
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        """
+        A context manager that records the peak traced memory while the given stage runs. Stages may be nested, the
+        peak of an outer stage includes its inner stages. The context manager yields the [name, peak] record of the
+        stage, whose peak is final when the stage ends
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._update_open_stages()
+        tracemalloc.reset_peak()
+        self._open_stages.append([name, 0])
+        try:
+            yield self._open_stages[-1]
+        finally:
+            self._update_open_stages()
+            name, peak = self._open_stages.pop()
+            self.stage_peaks[name] = max(self.stage_peaks.get(name, 0), peak)
+
+    def _update_open_stages(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_stage in self._open_stages:
+            open_stage[1] = max(open_stage[1], peak)
+
+    def allows(self, name, estimated_bytes):
+        """
+        A function that checks whether the given stage can allocate the given number of bytes on top of the memory that
+        is currently in use without exceeding the limit
+        :return the function returns True if it can. If it can not, the function raises MemoryBudgetExceeded if
+        on_exceed is 'raise', and otherwise records the stage as degraded and returns False
+        """
+        if self.limit is None:
+            return True
+        in_use = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        if in_use + estimated_bytes <= self.limit:
+            return True
+        if self.on_exceed == 'raise':
+            raise MemoryBudgetExceeded('%s needs about %.1f MB on top of %.1f MB in use, the budget is %.1f MB' %
+                                       (name, estimated_bytes / 2 ** 20, in_use / 2 ** 20, self.limit / 2 ** 20))
+        self.degraded_stages.append(name)
+        return False
+
+    def close(self):
+        """
+        A function that stops tracemalloc if it was started by this budget
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """
+        A function that returns a human readable summary of the peak memory of every stage
+        """
+        lines = ['%-26s %10.1f MB%s' % (name, peak / 2 ** 20, ' (low memory)' if name in self.degraded_stages else '')
+                 for name, peak in self.stage_peaks.items()]
+        if self.limit is not None:
+            lines.append('%-26s %10.1f MB' % ('budget', self.limit / 2 ** 20))
+        return '\n'.join(lines)
+
+
+class Tracer:
+    """
+    A class that records the wall time, CPU time and peak memory of every stage of the pipeline, and events inside the
+    stages, such as the iterations of the region growing. The records can be exported as a JSON trace or summarized
+    """
+
+    def __init__(self, trace_memory=True):
+        """
+        :param trace_memory: If True, the peak memory of every stage is measured with tracemalloc, which slows down
+        stages that allocate many small objects
+        """
+        self.trace_memory = trace_memory
+        self.stages = []  # the records of the stages, in the order in which they started
+        self.events = []  # events that happened outside of any stage
+        self._open_stages = []
+        self._memory_budget = None
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, memory_budget=None):
+        """
+        A context manager that records the given stage. Stages may be nested
+        :param memory_budget: The MemoryBudget of the run, which measures the peak memory of the stage. If None and
+        trace_memory is True, a budget without a limit of the tracer is used
+        :return the context manager yields the record of the stage
+        """
+        if memory_budget is None and self.trace_memory:
+            if self._memory_budget is None:
+                self._memory_budget = MemoryBudget()
+            memory_budget = self._memory_budget
+        record = {'name': name, 'parent': self._open_stages[-1]['name'] if self._open_stages else None,
+                  'start_s': time.perf_counter() - self._origin, 'values': {}, 'events': []}
+        self.stages.append(record)
+        self._open_stages.append(record)
+
+        memory_record = None
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            with memory_budget.stage(name) if memory_budget is not None else nullcontext() as memory_record:
+                yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = time.process_time() - start_cpu
+            if memory_record is not None:
+                record['peak_memory_mb'] = memory_record[1] / 2 ** 20
+            self._open_stages.pop()
+
+    def event(self, name, **values):
+        """
+        A function that records an event with the given values in the innermost running stage
+        """
+        event = dict(values, name=name, time_s=time.perf_counter() - self._origin)
+        (self._open_stages[-1]['events'] if self._open_stages else self.events).append(event)
+
+    def annotate(self, **values):
+        """
+        A function that records the given values (e.g. the size of a result) in the innermost running stage
+        """
+        if self._open_stages:
+            self._open_stages[-1]['values'].update(values)
+
+    def close(self):
+        """
+        A function that stops tracemalloc if it was started by the tracer
+        """
+        if self._memory_budget is not None:
+            self._memory_budget.close()
+
+    def to_json(self, file_name):
+        """
+        A function that writes the records of the stages and the events to the given JSON file
+        """
+        with open(file_name, 'w') as f:
+            json.dump({'stages': self.stages, 'events': self.events}, f, indent=2, default=float)
+
+    def summary(self):
+        """
+        A function that returns a human readable summary of the stages. A stage that ran several times is summed up,
+        and its peak memory is the largest peak of its runs
+        """
+        totals = OrderedDict()
+        for record in self.stages:
+            total = totals.setdefault(record['name'], {'runs': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'events': 0})
+            total['runs'] += 1
+            total['wall_s'] += record.get('wall_s', 0.0)
+            total['cpu_s'] += record.get('cpu_s', 0.0)
+            total['events'] += len(record['events'])
+            if 'peak_memory_mb' in record:
+                total['peak_memory_mb'] = max(total.get('peak_memory_mb', 0.0), record['peak_memory_mb'])
+
+        lines = ['%-26s %5s %10s %10s %12s %8s' % ('stage', 'runs', 'wall [s]', 'cpu [s]', 'peak [MB]', 'events')]
+        for name, total in totals.items():
+            peak = '%12.1f' % total['peak_memory_mb'] if 'peak_memory_mb' in total else '%12s' % '-'
+            lines.append('%-26s %5d %10.3f %10.3f %s %8d' % (name, total['runs'], total['wall_s'], total['cpu_s'],
+                                                           peak, total['events']))
+        return '\n'.join(lines)
+
+
+def as_context(ctFileName, AortaFileName=None):
+    """
+    A function that returns the given PipelineContext, or creates a new one if a path to a CT file was given
+    """
+    if isinstance(ctFileName, PipelineContext):
+        return ctFileName
+    return PipelineContext(ctFileName, AortaFileName)
+
+
+def segmentLiver(ctFileName, AortaFileName, outputFileName, save_debug=False, rng=None, memory_budget=None,
+                 volume_cache=None, stage_cache=None, debug_dir=None, params=None, tracer=None, slab_size=None,
+                 output_format=None):
+    """
+    A function that receives the names of the aorta and CT files it should use, and segments the liver in the original
+    CT. The function saves a segmentation file called 'outputFileName'
+    :param save_debug: If True, the intermediate segmentations are saved as nii.gz files next to the CT file
+    :param rng: A np.random.Generator or a seed for the selection of the seeds, for reproducible segmentations
+    :param memory_budget: A limit in bytes or a MemoryBudget. If given, the peak memory of every stage is measured and
+    can be printed with its report function, and its limit and the stages that switched to a lower memory strategy are
+    recorded as a 'memory_budget' event of the tracer
+    :param volume_cache: A cache.VolumeCache to load the CT and aorta files through
+    :param stage_cache: A cache.StageCache to reuse the results of IsolateBody, find_ROI and find_seeds
+    :param debug_dir: The directory of the intermediate nii.gz files that are saved if save_debug is True
+    :param params: A SegmentationParams, by default the module constants
+    :param tracer: A Tracer that records the time and memory of every stage of the run
+    :param slab_size: If given, the CT is processed in slabs of slab_size slices where possible, which bounds the memory
+    of the body segmentation and of the post processing by the size of a slab
+    :param output_format: An OutputFormat of the segmentation and of the intermediate files. By default they are uint8
+    '.nii.gz' files
+    :return the function returns the name of the saved segmentation file
+    """
+    if memory_budget is not None and not isinstance(memory_budget, MemoryBudget):
+        memory_budget = MemoryBudget(memory_budget)
+    try:
+        context = PipelineContext(ctFileName, AortaFileName, save_debug, memory_budget, volume_cache, stage_cache,
+                                  debug_dir, tracer, slab_size, output_format)
+
+        liver_data = segment_context(context, rng, params)
+
+        # save the segmentation of the liver as a nifti file
+        with context.stage('save'):
+            return context.save_volume(liver_data, outputFileName)
+    finally:
+        if tracer is not None:
+            if memory_budget is not None:
+                tracer.event('memory_budget', limit=memory_budget.limit,
+                             degraded_stages=list(memory_budget.degraded_stages))
+            tracer.close()
+        if memory_budget is not None:
+            memory_budget.close()
+
+
+def segment_context(context, rng=None, params=None):
+    """
+    A function that runs all the stages of the segmentation of the liver on the volumes of the given PipelineContext.
+    The stages whose results are already in the context (the body segmentation and the ROI) are not run again
+    :return the function returns the boolean segmentation of the liver, in the orientation of the context
+    """
+    params = params or SegmentationParams()
+    if params.post_processing not in POST_PROCESSING_MODES:
+        raise ValueError('Unknown post processing mode: %s' % params.post_processing)
+
+    with context.stage('isolate_body'):
+        IsolateBody(context)
+    with context.stage('find_ROI'):
+        ROI_segmentation = find_ROI(context, params=params)
+    liver_data = multipleSeedsRG(context, ROI_segmentation, rng=rng, params=params)
+
+    # perform morphological operation on the liver segmentation that was created, only inside the body
+    if params.post_processing == 'slice_chain':
+        # fill the small holes of every slice and keep its largest component, which also removes the holes that were
+        # connected to other components. The slices are processed in slabs in the streaming mode, and one by one if
+        # the whole stack does not fit the memory budget
+        with context.stage('post_processing'):
+            box = context.crop_box
+            cropped_liver_data = liver_data[box]
+            slab_size = context.slab_size
+            if slab_size is None and not context.memory_allows(
+                    'post_processing', cropped_liver_data.size * POST_PROCESSING_BYTES_PER_VOXEL):
+                slab_size = 1
+            for _, start, stop in slab_ranges(cropped_liver_data.shape[2], slab_size or cropped_liver_data.shape[2]):
+                slab = fill_small_holes(cropped_liver_data[:, :, start:stop])
+                cropped_liver_data[:, :, start:stop] = keep_largest_components(slab, per_slice=True)
+
+        # remove over-segmentation slices:
+        with context.stage('remove_over_segmentation'):
+            liver_data = remove_over_segmentation(liver_data, context)
+    else:
+        # fill the cavities of the whole volume and keep the 3D component of the middle slice of the aorta, which
+        # replaces the slice by slice chain of remove_over_segmentation
+        with context.stage('post_processing'):
+            box = context.crop_box
+            anchor_slice = aorta_mid_slice(context.aorta_index) - box[2].start
+            anchor_slice = min(max(anchor_slice, 0), liver_data[box].shape[2] - 1)
+            liver_data[box] = keep_anchored_component(ndimage.binary_fill_holes(liver_data[box]), anchor_slice)
+    return liver_data
+
+
+@dataclass
+class SegmentationMetrics:
+    """
+    The evaluation of an estimated segmentation against the ground truth, as returned by evaluateSegmentation. All
+    distances are in mm
+    """
+    VOD: float
+    dice_coefficient: float
+    ASSD: float
+    hausdorff: float
+    hausdorff_95: float
+    surface_dice: float
+    surface_tolerance: float
+
+
+@dataclass
+class SurfaceMetrics:
+    """
+    The distances between the surfaces of two segmentations, as returned by surface_metrics. All distances are in mm
+    """
+    ASSD: float
+    hausdorff: float
+    hausdorff_95: float
+    surface_dice: float
+    surface_tolerance: float
+
+
+def evaluateSegmentation(ground_truth_segmentation, estimated_segmentation, surface_tolerance=SURFACE_TOLERANCE,
+                         volume_cache=None):
     """
     A function that evaluates the segmentation of the liver using the parameters mentioned in the guidelines
     :param ground_truth_segmentation: The path to the true segmentation of the aorta as provided in the exercise
     :param estimated_segmentation: The path to the segmentation created in the AortaSegmentation function
-    :return: The VOD and dice coefficient values
+    :param surface_tolerance: The tolerance in mm of the surface dice
+    :param volume_cache: A cache.VolumeCache to load the segmentations through
+    :return: A SegmentationMetrics with the VOD, dice coefficient, ASSD, Hausdorff distance, 95th percentile
+    Hausdorff distance and surface dice
     """
-    true_seg = nib.load(ground_truth_segmentation)
-    est_seg = nib.load(estimated_segmentation)
+    true_seg = load_nifti(ground_truth_segmentation, volume_cache)
+    est_seg = load_nifti(estimated_segmentation, volume_cache)
     header = true_seg.header
 
-    true_seg_data = true_seg.get_data()
-    est_seg_data = est_seg.get_data()
+    liver_true_data = np.asanyarray(true_seg.dataobj) != 0
+    est_seg_data = np.asanyarray(est_seg.dataobj) != 0
 
     # find borders of segmentation:
-    lower_border = 0
-    while not est_seg_data[:, :, lower_border].any():
-        lower_border += 1
-    upper_border = lower_border
-    while est_seg_data[:, :, upper_border].any():
-        upper_border += 1
+    lower_border, upper_border = OccupancyIndex(est_seg_data).axis_range(2) or (0, 0)
 
+    true_seg_data = liver_true_data.copy()
     true_seg_data[:, :, :lower_border] = 0
     true_seg_data[:, :, upper_border:] = 0
-    true_seg_data[true_seg_data != 0] = 1
 
     pixel_volume = header['pixdim'][1] * header['pixdim'][2] * header['pixdim'][3]
 
@@ -106,257 +772,473 @@ def evaluateSegmentation(ground_truth_segmentation, estimated_segmentation):
     VOD = 1 - (intersection_volume / union_volume)
     dice_coefficient = (2 * intersection_volume) / (true_seg_volume + est_seg_volume)
 
-    ASSD = calc_ASSD(ground_truth_segmentation, estimated_segmentation)
+    # the surface distances are computed for the whole true segmentation, as in calc_ASSD:
+    surface = surface_metrics(liver_true_data, est_seg_data, header['pixdim'][1:4], surface_tolerance,
+                              ground_truth_segmentation, estimated_segmentation)
 
-    return VOD, dice_coefficient, ASSD
+    return SegmentationMetrics(VOD, dice_coefficient, **asdict(surface))
 
 
-def multipleSeedsRG(ctFileName, ROI_segmentation, orientation_flags):
+def multipleSeedsRG(ctFileName, ROI_segmentation, *, exact=None, criterion=None, rng=None, params=None):
     """
     A function that executes multiple seeded region growing for the given CT, based on seeds selected from the given ROI
+    :param ctFileName: The path to the CT scan or the PipelineContext of the current run
+    :param exact: see region_growing. By default the growing_exact of params
+    :param criterion: The acceptance criterion of the region growing, 'window' or 'sigma', see region_growing. By
+    default the growing_criterion of params
+    :param rng: A np.random.Generator or a seed for the selection of the seeds, see find_seeds
+    :param params: A SegmentationParams with the parameters of the region growing and of find_seeds
     :return The function returns the resulting segmentation of the liver, with no morphological operation performed yet
     """
-    print('start: region_growing')
-    file_name = ctFileName.split('.')[0]
-    ct_img = nib.load(ctFileName)
-    ct_data = ct_img.get_data()
-    seeds_seg = nib.load(ctFileName)
-    seeds_data = seeds_seg.get_data()
-
-    # flip the axes if required:
-    if orientation_flags.any():
-        ct_data = flip_axis(ct_data, orientation_flags)
-        seeds_data = flip_axis(seeds_data, orientation_flags)
-
-    seeds_list = find_seeds(ctFileName, ROI_segmentation, orientation_flags)
-
-    # todo: COMMENT BEFORE SUBMISSION!
-    ####################################################################################################################
-    # Following lines create a new nifti file called '<file_name>_seeds_list.nii.gz', so the seeds that where selected
-    # can be seen using ITK-Snap. Uncomment these lines in order to create this file.
-    ####################################################################################################################
-    seeds_data[::] = 0
-    for seed in seeds_list:
-        seeds_data[seed[0], seed[1], seed[2]] = 1
-    nib.save(seeds_seg, file_name + '_seeds_list.nii.gz')
-    print('seeds data saved')  # todo: delete before submission!
-
-    # perform seeded region growing:
-    cube = morphology.cube(3)
-    last_region = copy.deepcopy(seeds_data).astype(np.uint8)
-    cur_region = morphology.dilation(last_region, cube).astype(np.uint8)
-    last_region_num = np.sum(last_region)
-    cur_region_num = np.sum(cur_region)
-    i = 0
-    # for i in range(GROWING_REPS):
-    while last_region_num != cur_region_num:
-        print(i)  # todo: delete!
-        region_mean = np.mean(ct_data[last_region == 1])
-        neighbors_flags = np.zeros(ct_data.shape)
-        neighbors_indexes = np.subtract(cur_region, last_region)
-        neighbors_flags[neighbors_indexes == 1] = ct_data[neighbors_indexes == 1]
-        neighbors_flags[np.abs(neighbors_flags - region_mean) <= 20] = 1
-        neighbors_flags[neighbors_flags != 1] = 0
-        last_region = np.logical_or(neighbors_flags, last_region).astype(np.uint8)
-        if i % 2:
-            cur_region_num = np.sum(last_region)
+    context = as_context(ctFileName)
+    params = params or SegmentationParams()
+
+    with context.stage('find_seeds'):
+        seeds_list = find_seeds(context, ROI_segmentation, rng=rng, params=params)
+    seeds_data = np.zeros(context.shape, dtype=bool)
+    seeds_data[tuple(seeds_list.T)] = True
+    context.save_debug_volume(seeds_data, '_seeds_list')
+
+    # perform seeded region growing inside the body, the region can not grow outside of it since every voxel of the
+    # region is connected to the seeds and is in the HU range of the body:
+    with context.stage('region_growing'):
+        box = context.crop_box
+        cropped_size = np.prod([axis_slice.stop - axis_slice.start for axis_slice in box])
+        estimated_bytes = cropped_size * (GROWING_BYTES_PER_VOXEL + GROWING_FRONTIER_FRACTION * NEIGHBOR_BYTES)
+        chunk_size = None if context.memory_allows('region_growing', estimated_bytes) else GROWING_CHUNK_SIZE
+        last_region = multiresolution_region_growing(context.ct_box(box), seeds_data[box], params.growing_levels,
+                                                     params.growing_tolerance,
+                                                     exact=params.growing_exact if exact is None else exact,
+                                                     criterion=criterion or params.growing_criterion,
+                                                     sigma_factor=params.growing_sigma_factor, chunk_size=chunk_size,
+                                                     tracer=context.tracer)
+        last_region = uncrop(last_region, box, context.shape)
+
+    context.save_debug_volume(last_region, '_region_growing')
+    return last_region
+
+
+def region_growing(ct_data, seeds_data, tolerance=GROWING_TOLERANCE, exact=True, criterion='window',
+                   sigma_factor=GROWING_SIGMA_FACTOR, chunk_size=None, tracer=None, allowed=None):
+    """
+    A function that grows a region from the given seeds. In every iteration the 26-connected neighbours of the region
+    whose value is within the acceptance range around the mean of the region are added to it, until no voxel is added.
+    Only the frontier of the region (the neighbours that are not in the region) is kept and examined, so the cost of an
+    iteration depends on the size of the frontier and not on the size of the CT. The statistics of the region are
+    updated only from the newly accepted voxels, see RegionStatistics
+    :param ct_data: The CT scan
+    :param seeds_data: A volume of the same shape as ct_data in which the seeds are non zero
+    :param tolerance: The maximal distance in HU of an accepted voxel from the mean of the region ('window' criterion)
+    :param exact: If True, rejected neighbours are examined again in every iteration (with the updated mean of the
+    region), which gives the same result as dilating the whole region in every iteration. If False, every voxel is
+    examined only once, which is faster but the result may be slightly smaller
+    :param criterion: 'window' accepts voxels within +-tolerance HU of the mean of the region, 'sigma' accepts voxels
+    within +-sigma_factor standard deviations of the mean of the region
+    :param sigma_factor: The width of the acceptance band in standard deviations ('sigma' criterion)
+    :param chunk_size: If given, the neighbours of at most chunk_size voxels are computed at once, which bounds the
+    memory of an iteration
+    :param tracer: A Tracer in which the frontier size and the region mean of every iteration and the size of the final
+    region are recorded
+    :param allowed: If given, a boolean volume of the same shape as ct_data, and the region grows only inside it
+    :return The function returns the segmentation of the grown region as a boolean volume
+    """
+    if criterion not in ('window', 'sigma'):
+        raise ValueError("criterion must be 'window' or 'sigma', got %r" % (criterion,))
+
+    shape = ct_data.shape
+    region = np.zeros(seeds_data.size, dtype=bool)
+    region_indexes = np.flatnonzero(seeds_data)
+    region[region_indexes] = True
+    region_stats = RegionStatistics(ct_data[np.unravel_index(region_indexes, shape)])
+    if allowed is not None:
+        allowed = allowed.ravel()
+
+    # only the seeds on the boundary of a large seeds region have neighbours outside of it:
+    if region_indexes.size > GROWING_CHUNK_SIZE:
+        box = bounding_box(seeds_data, padding=1)
+        inner_seeds = ndimage.binary_erosion(seeds_data[box], np.ones((3, 3, 3), dtype=bool), border_value=1)
+        region_indexes = np.flatnonzero(np.logical_and(seeds_data, np.logical_not(uncrop(inner_seeds, box, shape))))
+
+    # voxels that were examined and rejected are only remembered in the non exact mode:
+    visited = None if exact else region.copy()
+    frontier = neighbor_indexes(region_indexes, shape, chunk_size)
+    frontier = frontier[~region[frontier]]
+    if allowed is not None:
+        frontier = frontier[allowed[frontier]]
+    if visited is not None:
+        visited[frontier] = True
+
+    while frontier.size:
+        if criterion == 'window':
+            max_distance = tolerance
+        else:
+            max_distance = sigma_factor * region_stats.std
+        frontier_values = ct_data[np.unravel_index(frontier, shape)]
+        accepted_flags = np.abs(frontier_values - region_stats.mean) <= max_distance
+        if tracer is not None:
+            tracer.event('region_growing_iteration', frontier_size=int(frontier.size),
+                         accepted=int(np.count_nonzero(accepted_flags)), region_mean=float(region_stats.mean))
+        if not accepted_flags.any():
+            break
+
+        accepted = frontier[accepted_flags]
+        region[accepted] = True
+        region_stats.add(frontier_values[accepted_flags])
+
+        # the new frontier consists of the new neighbours of the accepted voxels, and in the exact mode also of the
+        # neighbours that were rejected in this iteration
+        new_frontier = neighbor_indexes(accepted, shape, chunk_size)
+        if allowed is not None:
+            new_frontier = new_frontier[allowed[new_frontier]]
+        if visited is None:
+            new_frontier = new_frontier[~region[new_frontier]]
+            frontier = np.union1d(frontier[~accepted_flags], new_frontier)
         else:
-            last_region_num = np.sum(last_region)
-        cur_region = morphology.binary_dilation(last_region, cube).astype(np.uint8)
+            new_frontier = new_frontier[~visited[new_frontier]]
+            visited[new_frontier] = True
+            frontier = new_frontier
 
-        if not i % 10:  # todo: delete this lines!
-            print(cur_region_num)
+    if tracer is not None:
+        tracer.annotate(region_size=region_stats.count, region_mean=float(region_stats.mean))
+    return region.reshape(shape)
 
-        i += 1
 
-    print(last_region_num)
-    seeds_data[:, :, :] = 0
-    seeds_data[last_region == 1] = 1
+def multiresolution_region_growing(ct_data, seeds_data, levels=GROWING_LEVELS, tolerance=GROWING_TOLERANCE, exact=True,
+                                   criterion='window', sigma_factor=GROWING_SIGMA_FACTOR,
+                                   band_width=GROWING_BAND_WIDTH, chunk_size=None, tracer=None):
+    """
+    A function that grows a region from the given seeds coarse to fine. The region is grown on a downsampled CT (the
+    mean of every GROWING_PYRAMID_FACTORS block of voxels), upsampled, and then grown again at the finer resolution
+    only in a narrow band around its boundary: the voxels deeper than band_width inside the upsampled region are the
+    seeds of the finer growth, and the region can not grow further than band_width outside of it. With levels=1 this is
+    region_growing
+    :param levels: The number of resolutions, including the full resolution
+    :param band_width: The width in voxels of the band that is grown again at every finer resolution
+    :return The function returns the segmentation of the grown region as a boolean volume, see region_growing
+    """
+    coarse_shape = [size // factor for size, factor in zip(ct_data.shape, GROWING_PYRAMID_FACTORS)]
+    if levels <= 1 or min(coarse_shape) < 2 * band_width + 1:
+        return region_growing(ct_data, seeds_data, tolerance, exact, criterion, sigma_factor, chunk_size, tracer)
+
+    coarse_ct = downsample(ct_data, GROWING_PYRAMID_FACTORS, lambda blocks, axis: blocks.mean(axis, np.float32))
+    coarse_seeds = downsample(seeds_data, GROWING_PYRAMID_FACTORS, np.any)
+    coarse_region = multiresolution_region_growing(coarse_ct, coarse_seeds, levels - 1, tolerance, exact, criterion,
+                                                   sigma_factor, band_width, chunk_size, tracer)
+    if tracer is not None:
+        tracer.event('region_growing_level', levels=levels, shape=list(ct_data.shape))
+
+    # the finer growth is limited to the band around the upsampled region, so it runs inside its bounding box:
+    region = upsample(coarse_region, GROWING_PYRAMID_FACTORS, ct_data.shape)
+    box = bounding_box(region, padding=band_width + 1)
+    region = region[box]
+    structure = np.ones((3, 3, 3), dtype=bool)
+    allowed = ndimage.binary_dilation(region, structure, iterations=band_width)
+    seeds_data = np.logical_or(ndimage.binary_erosion(region, structure, iterations=band_width, border_value=1),
+                               np.logical_and(seeds_data[box], allowed))
+    region = region_growing(ct_data[box], seeds_data, tolerance, exact, criterion, sigma_factor, chunk_size, tracer,
+                            allowed=allowed)
+    return uncrop(region, box, ct_data.shape)
+
+
+def downsample(data, factors, reduce):
+    """
+    A function that downsamples the given volume by reducing every block of factors voxels to one voxel. The volume is
+    padded by repeating its last voxels to a multiple of the factors
+    :param reduce: A function such as np.any that reduces an array along the given tuple of axes
+    """
+    padding = [(0, -size % factor) for size, factor in zip(data.shape, factors)]
+    padded = np.pad(data, padding, mode='edge')
+    blocks_shape = []
+    for size, factor in zip(padded.shape, factors):
+        blocks_shape.extend([size // factor, factor])
+    return reduce(padded.reshape(blocks_shape), axis=(1, 3, 5))
 
-    # Saves the result of the region growing
-    nib.save(seeds_seg, file_name + '_region_growing.nii.gz')
-    print('region growing saved')
-    print('end: region_growing')
-    # return seeds_data  # todo: check! was seeds_seg before 07/12 - I think can be deleted
+
+def upsample(data, factors, shape):
+    """
+    A function that upsamples the given volume by repeating every voxel factors times, and crops it to the given shape
+    """
+    for axis, factor in enumerate(factors):
+        data = np.repeat(data, factor, axis=axis)
+    return data[:shape[0], :shape[1], :shape[2]]
 
 
-def find_seeds(ctFileName, ROI_segmentation, orientation_flags):
+class RegionStatistics:
     """
-    A function that receives a CT scan and an ROI segmentation of the CT and returns a list of 200 seeds that are
-    located within the liver
+    A class that keeps the number of voxels, the mean and the variance of the values of a growing region. The
+    statistics are updated only from the values that are added to the region, using the pairwise update of Chan et al.,
+    so the values of the whole region are never gathered again
     """
-    print('start: find_seeds')
-    ct_img = nib.load(ctFileName)
-    ct_data = ct_img.get_data()
-    if orientation_flags.any():
-        ct_data = flip_axis(ct_data, orientation_flags)
-    ROI_data = ROI_segmentation
-    seeds = []
-
-    # find the borders of the ROI:
-    upper_z = max([z if ROI_data[:, :, z].any() else 0 for z in range(ROI_data.shape[2])])
-    lower_z = min([z if ROI_data[:, :, z].any() else 512 for z in range(ROI_data.shape[2])])
-    upper_x = max([row if ROI_data[:, row, :].any() else 0 for row in range(ROI_data.shape[1])])
-    lower_x = min([row if ROI_data[:, row, :].any() else 512 for row in range(ROI_data.shape[1])])
-    left_y = max([col if ROI_data[col, :, :].any() else 0 for col in range(ROI_data.shape[0])])
-    right_y = min([col if ROI_data[col, :, :].any() else 512 for col in range(ROI_data.shape[0])])
-
-    # randomly sample points in the ROI and validate that they are in the liver
-    while len(seeds) < SEEDS_NUM:
-        z = np.random.randint(lower_z, upper_z + 1)
-        x = np.random.randint(lower_x, upper_x + 1)
-        y = np.random.randint(right_y + 50, left_y + 1)
-
-        if LIVER_MIN_TH < ct_data[y, x, z] < LIVER_MAX_TH and ROI_data[y, x, z]:
-            seeds.append([y, x, z])
-
-    print('end: find_seeds')
 
+    def __init__(self, values=()):
+        self.count = 0
+        self.mean = 0.0
+        self.squares_sum = 0.0  # sum of the squared distances from the mean
+        self.add(values)
+
+    def add(self, values):
+        """
+        A function that adds the given values to the statistics of the region
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        added_count = values.size
+        added_mean = values.mean()
+        added_squares_sum = np.sum((values - added_mean) ** 2)
+
+        total_count = self.count + added_count
+        delta = added_mean - self.mean
+        self.mean += delta * added_count / total_count
+        self.squares_sum += added_squares_sum + delta ** 2 * self.count * added_count / total_count
+        self.count = total_count
+
+    @property
+    def variance(self):
+        return self.squares_sum / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def neighbor_indexes(indexes, shape, chunk_size=None):
+    """
+    A function that returns the sorted unique flat indexes of the 26-connected neighbours of the given flat indexes that
+    lie inside a volume of the given shape
+    :param chunk_size: If given, the neighbours of at most chunk_size indexes are computed at once
+    """
+    if chunk_size is not None and indexes.size > chunk_size:
+        return np.unique(np.concatenate([neighbor_indexes(indexes[i:i + chunk_size], shape)
+                                         for i in range(0, indexes.size, chunk_size)]))
+    coordinates = np.array(np.unravel_index(indexes, shape))
+    neighbors = coordinates[:, :, np.newaxis] + NEIGHBOR_OFFSETS[:, np.newaxis, :]
+    inside_flags = np.all((neighbors >= 0) & (neighbors < np.array(shape)[:, np.newaxis, np.newaxis]), axis=0)
+    return np.unique(np.ravel_multi_index(tuple(neighbors[:, inside_flags]), shape))
+
+
+def find_seeds(ctFileName, ROI_segmentation, *, rng=None, stratified=None, params=None):
+    """
+    A function that receives a CT scan and an ROI segmentation of the CT and returns a list of seeds (200 by default)
+    that are located within the liver. The candidates are all the voxels of the ROI in the HU range of the liver, and
+    the seeds are drawn from them at once
+    :param ctFileName: The path to the CT scan or the PipelineContext of the current run
+    :param rng: A np.random.Generator or a seed for np.random.default_rng, for reproducible seeds
+    :param stratified: If True, the ROI is divided into a grid of STRATA_GRID x STRATA_GRID cells in the axial plane and
+    the seeds are divided between the cells in proportion to their number of candidates, so the seeds are spread over
+    the whole ROI. By default the stratified_seeds of params
+    :param params: A SegmentationParams with the number of seeds, the HU range of the liver, the seed offset and the
+    sampling of the seeds
+    :return the function returns the seeds as an (N, 3) array of voxel coordinates
+    """
+    context = as_context(ctFileName)
+    params = params or SegmentationParams()
+    stratified = params.stratified_seeds if stratified is None else stratified
+
+    # the seeds are cached only if they are reproducible, which is when the seed of the generator is given:
+    cache_key = None
+    if isinstance(rng, (int, np.integer)):
+        seeds_params = {'seeds_num': params.seeds_num, 'liver_min_th': params.liver_min_th,
+                        'liver_max_th': params.liver_max_th, 'seed_offset': params.seed_offset,
+                        'stratified': stratified, 'strata_grid': STRATA_GRID, 'rng': int(rng)}
+        cache_key = context.stage_key('find_seeds', seeds_params, input_hashes=[mask_hash(ROI_segmentation)])
+    seeds = context.load_stage(cache_key)
+    if seeds is not None:
+        return seeds
+    rng = np.random.default_rng(rng)
+
+    # the candidates are the voxels of the ROI that are in the HU range of the liver, skipping the first seed_offset
+    # columns of the ROI when this leaves any candidates. Only the slices of the ROI are read from the CT:
+    candidates = np.argwhere(ROI_segmentation)
+    first_column = candidates[:, 0].min() if candidates.size else 0
+    lower_slice = candidates[:, 2].min() if candidates.size else 0
+    ct_slab = context.ct_slab(lower_slice, candidates[:, 2].max() + 1 if candidates.size else 0)
+    candidates_values = ct_slab[candidates[:, 0], candidates[:, 1], candidates[:, 2] - lower_slice]
+    candidates = candidates[np.logical_and(params.liver_min_th < candidates_values,
+                                           candidates_values < params.liver_max_th)]
+    if not candidates.size:
+        raise ValueError('The ROI does not contain voxels in the HU range of the liver')
+    offset_flags = candidates[:, 0] >= first_column + params.seed_offset
+    if offset_flags.any():
+        candidates = candidates[offset_flags]
+
+    if not stratified:
+        seeds = candidates[sample_indexes(rng, candidates.shape[0], params.seeds_num)]
+    else:
+        # the cell of every candidate in a grid over the bounding box of the candidates:
+        low = candidates[:, :2].min(axis=0)
+        cell_size = (candidates[:, :2].max(axis=0) - low) // STRATA_GRID + 1
+        cells = (candidates[:, :2] - low) // cell_size
+        cells = cells[:, 0] * STRATA_GRID + cells[:, 1]
+
+        # divide the seeds between the cells by their number of candidates, using the largest remainders:
+        cells_candidates = np.bincount(cells, minlength=STRATA_GRID ** 2)
+        cells_share = cells_candidates * params.seeds_num / candidates.shape[0]
+        cells_seeds = np.floor(cells_share).astype(int)
+        remainder_order = np.argsort(cells_seeds - cells_share, kind='stable')
+        cells_seeds[remainder_order[:params.seeds_num - cells_seeds.sum()]] += 1
+
+        seeds = np.concatenate([candidates[cells == cell][sample_indexes(rng, cells_candidates[cell], seeds_num)]
+                                for cell, seeds_num in enumerate(cells_seeds) if seeds_num])
+
+    context.store_stage(cache_key, seeds)
     return seeds
 
 
-def find_ROI(ctFileName, AortaFileName, orientation_flags):
+def sample_indexes(rng, population_size, sample_size):
+    """
+    A function that draws sample_size indexes out of range(population_size), without repetitions if possible
+    """
+    return rng.choice(population_size, sample_size, replace=population_size < sample_size)
+
+
+def find_ROI(ctFileName, AortaFileName=None, *, params=None):
     """
     A function that finds an ROI of the liver for the given CT file using the segmentation of the aorta.
-    :return the function returns a segmentation file in format nifti of the CT such that all pixels in the ROI are 1
-    and the rest are 0
+    :param ctFileName: The path to the CT scan or the PipelineContext of the current run
+    :param AortaFileName: The path to the segmentation of the aorta, not required if a PipelineContext is given
+    :param params: A SegmentationParams with the radius of the skin outline that is removed from the ROI
+    :return the function returns a boolean segmentation of the CT such that all pixels in the ROI are True
     """
-    print('start: find_ROI')
-    file_name = ctFileName.split('.')[0]
+    context = as_context(ctFileName, AortaFileName)
+    params = params or SegmentationParams()
+    roi_key = (params.skin_radius, params.skin_radius_mm)
+    if roi_key in context.roi_data:
+        return context.roi_data[roi_key]
 
-    ct_img = nib.load(ctFileName)
-    ct_data = ct_img.get_data()
-    body_seg = IsolateBody(ctFileName)
-    # body_seg = nib.load('Case1_CT_bodySeg.nii.gz')  # todo: return use in IsolateBody
-    body_data = body_seg.get_data()
-    aorta_seg = nib.load(AortaFileName)
-    aorta_data = aorta_seg.get_data()
-
-    # flip the axes if required:
-    if orientation_flags.any():
-        ct_data = flip_axis(ct_data, orientation_flags)
-        body_data = flip_axis(body_data, orientation_flags)
-        aorta_data = flip_axis(aorta_data, orientation_flags)
-
-    # find borders of aorta:
-    lower_border = 0
-    while not aorta_data[:, :, lower_border].any():
-        lower_border += 1
-    upper_border = lower_border
-    while aorta_data[:, :, upper_border].any():
-        upper_border += 1
+    cache_key = context.stage_key('find_ROI', dict(body_params(), skin_radius=params.skin_radius,
+                                                   skin_radius_mm=params.skin_radius_mm), uses_aorta=True)
+    ROI_data = context.load_stage(cache_key)
+    if ROI_data is not None:
+        context.roi_data[roi_key] = ROI_data
+        return ROI_data
 
-    aorta_mid = int((upper_border + lower_border) / 2)
+    box = context.crop_box
+    body_data = IsolateBody(context)[box]
+
+    # the ROI is built in the middle slice of the aorta:
+    aorta_mid = aorta_mid_slice(context.aorta_index)
 
     # find ROI borders
-    ROI_upper = max([row if aorta_data[:, row, aorta_mid].any() else 0 for row in range(aorta_data.shape[1])])
-    ROI_left = max([col if aorta_data[col, :, aorta_mid].any() else 0 for col in range(aorta_data.shape[0])])
-    ROI_lower = min([row if body_data[:, row, aorta_mid].any() else 512 for row in range(body_data.shape[1])])
-    ROI_right = max([col if body_data[col, :, aorta_mid].any() else 0 for col in range(body_data.shape[0])])
+    aorta_cols, aorta_rows = context.aorta_index.slice_ranges(aorta_mid)
+    body_cols, body_rows = context.body_index.slice_ranges(aorta_mid)
+    ROI_upper = aorta_rows[1] - 1
+    ROI_left = aorta_cols[1] - 1
+    ROI_lower = body_rows[0]
+    ROI_right = body_cols[1] - 1
+
+    # move to the coordinates of the cropped volumes:
+    aorta_mid -= box[2].start
+    ROI_left, ROI_right = ROI_left - box[0].start, ROI_right - box[0].start
+    ROI_lower, ROI_upper = ROI_lower - box[1].start, ROI_upper - box[1].start
 
     # find the outlines of the skin:
-    derivation_matrix = np.array([[0, 0, 0], [1, 0, -1], [0, 0, 0]])
-    dx = convolve2d(body_data[:, :, aorta_mid], derivation_matrix, mode='same', boundary='wrap')
-    dy = convolve2d(body_data[:, :, aorta_mid], derivation_matrix.T, mode='same', boundary='wrap')
-    skin_outline = np.sqrt(np.abs(dx) ** 2 + np.abs(dy) ** 2)  # calculates the magnitude of the derivatives
-    disk = morphology.disk(60)  # todo: check on more cases, maybe make a larger disk
-    skin_outline = morphology.dilation(skin_outline, disk)
-    skin_outline[skin_outline != 0] = 1
-    skin_segmentation = np.zeros(ct_data.shape)
-    skin_segmentation[:, :, aorta_mid] = skin_outline
-
-    # create the ROI - segmentation file with 1's in the ROI and 0's in the rest of the pixels
-    ROI_segmentation = np.zeros(ct_data.shape)
-    ROI_segmentation[ROI_left:ROI_right, ROI_lower:ROI_upper, aorta_mid] = 1
-    ROI_segmentation = np.logical_and(ROI_segmentation, body_data)
-    ROI_segmentation = np.subtract(ROI_segmentation, skin_segmentation)
-
-    ct_data[:, :, :] = 0
-    ct_data[ROI_segmentation == 1] = 1
-
-    # TODO: COMMENT BEFORE SUBMISSION!
-    ####################################################################################################################
-    # Uncomment to create a nii.gz file to visualize the ROI using ITK-Snap
-    ####################################################################################################################
-
-    nib.save(ct_img, file_name + '_ROI.nii.gz')
-    print('ROI_saved')
-    print('end: find_ROI')
+    skin_outline = find_surface(body_data[:, :, aorta_mid], connectivity=4)
+    # todo: check on more cases, maybe make a larger disk
+    if params.skin_radius_mm is None:
+        skin_outline = dilate_disk(skin_outline, params.skin_radius)
+    else:
+        skin_outline = dilate_disk(skin_outline, params.skin_radius_mm, context.header['pixdim'][1:3])
 
-    return ct_data
+    # create the ROI - segmentation with True in the ROI, which lies in the middle slice of the aorta:
+    ROI_slice = np.zeros(body_data.shape[:2], dtype=bool)
+    ROI_slice[ROI_left:ROI_right, ROI_lower:ROI_upper] = True
+    ROI_slice = np.logical_and(ROI_slice, body_data[:, :, aorta_mid])
+    ROI_slice = np.logical_and(ROI_slice, np.logical_not(skin_outline))
+
+    ROI_data = np.zeros(context.shape, dtype=bool)
+    ROI_data[box[0], box[1], aorta_mid + box[2].start] = ROI_slice
+    context.store_stage(cache_key, ROI_data)
+    context.roi_data[roi_key] = ROI_data
+
+    # create a nii.gz file to visualize the ROI using ITK-Snap
+    context.save_debug_volume(ROI_data, '_ROI')
+
+    return ROI_data
 
 
 def IsolateBody(CT_scan):
     """
     A function that segments the body in the given CT
-    :param CT_scan: The path to the CT scan that should be segmented
+    :param CT_scan: The path to the CT scan that should be segmented or the PipelineContext of the current run
     :return The function returns the segmentation of the body
     """
-    print('start: isolate_body')
-    file_name = CT_scan.split('.')[0]
+    context = as_context(CT_scan)
+    if context.body_data is not None:
+        return context.body_data
+
+    cache_key = context.stage_key('isolate_body', body_params())
+    img_data = context.load_stage(cache_key)
+    if img_data is None:
+        slab_size = context.slab_size
+        if slab_size is None and not context.memory_allows('isolate_body',
+                                                           np.prod(context.shape) * BODY_BYTES_PER_VOXEL):
+            slab_size = STREAMING_SLAB_SIZE
+        if slab_size is None:
+            ct_data = context.ct_data
+            img_data = np.logical_and(ct_data >= BODY_MIN_TH, ct_data <= BODY_MAX_TH)
+
+            # find largest connectivity component and remove all others:
+            img_data = keep_largest_components(img_data)
+        else:
+            def body_slab(start, stop):
+                ct_slab = context.ct_slab(start, stop)
+                return np.logical_and(ct_slab >= BODY_MIN_TH, ct_slab <= BODY_MAX_TH)
 
-    img = nib.load(CT_scan)
-    img_data = img.get_data()
+            img_data = keep_largest_component_slabs(body_slab, context.shape, slab_size)
+        context.store_stage(cache_key, img_data)
 
-    img_data[img_data == 0] = 1
-    img_data[img_data < -500] = 0
-    img_data[img_data > 2000] = 0
-    img_data[img_data != 0] = 1
+    # create a nii.gz file to visualize the body segmentation using ITK-Snap
+    context.save_debug_volume(img_data, '_bodySeg')
+    context.body_data = img_data
+    return img_data
 
-    # find largest connectivity component and remove all others:
-    img_data[::], new_connected_components_num = measure.label(img_data, return_num=True)
-    props = measure.regionprops(img_data.astype(np.uint16))
-    max_area = props[0].area
-    for i in range(1, new_connected_components_num):
-        if props[i].area > max_area:
-            max_area = props[i].area
-    img_data[::] = morphology.remove_small_objects(img_data.astype(np.uint16), max_area)
 
-    # TODO: COMMENT BEFORE SUBMISSION!
-    ####################################################################################################################
-    # Uncomment to create a nii.gz file to visualize the body segmentation using ITK-Snap
-    ####################################################################################################################
-    nib.save(img, file_name + '_bodySeg.nii.gz')
-    print('bodySeg saved')
-    print('end: isolate_body')
-    return img
+def body_params():
+    """
+    A function that returns the parameters that the body segmentation depends on, as part of the stage cache keys
+    """
+    return {'body_min_th': BODY_MIN_TH, 'body_max_th': BODY_MAX_TH}
 
 
 def remove_over_segmentation(ct_data, AortaFileName):
     """
-    A function that removes the slices in which over segmentation has been done
+    A function that removes the slices in which over segmentation has been done. Going up from the middle slice of the
+    aorta, and down from the slice below it, the segmentation is removed from the first slice that does not intersect
+    the previous one, and from all the slices after it
+    :param AortaFileName: The path to the segmentation of the aorta or the PipelineContext of the current run
     """
-    aorta_seg = nib.load(AortaFileName)
-    aorta_data = aorta_seg.get_data()
-
-    # find borders of aorta:
-    lower_border = 0
-    while not aorta_data[:, :, lower_border].any():
-        lower_border += 1
-    upper_border = lower_border
-    while aorta_data[:, :, upper_border].any():
-        upper_border += 1
-    aorta_mid = int((upper_border + lower_border) / 2)
-
-    for slc in range(aorta_mid, ct_data.shape[2] - 1):
-        cur_slc = ct_data[:, :, slc]
-        upper_slc = ct_data[:, :, slc + 1]
-        intersection_flags = np.logical_and(cur_slc, upper_slc)
-
-        # if there is no intersection between the two, remove the upper slice segmentation
-        if not intersection_flags.any():
-            ct_data[:, :, slc + 1] = 0
-
-    for slc in reversed(range(1, aorta_mid)):
-        cur_slc = ct_data[:, :, slc]
-        lower_slc = ct_data[:, :, slc - 1]
-        intersection_flags = np.logical_and(cur_slc, lower_slc)
+    if isinstance(AortaFileName, PipelineContext):
+        aorta_index = AortaFileName.aorta_index
+    else:
+        aorta_index = OccupancyIndex(np.asanyarray(nib.load(AortaFileName).dataobj))
+    aorta_mid = aorta_mid_slice(aorta_index)
+
+    # for every slice but the last one, whether it intersects the slice above it:
+    intersection_flags = np.zeros(max(ct_data.shape[2] - 1, 0), dtype=bool)
+    for _, start, stop in slab_ranges(intersection_flags.size, STREAMING_SLAB_SIZE):
+        intersection_flags[start:stop] = np.logical_and(ct_data[:, :, start:stop],
+                                                        ct_data[:, :, start + 1:stop + 1]).any(axis=(0, 1))
+
+    upper_gaps = np.flatnonzero(~intersection_flags[aorta_mid:])
+    if upper_gaps.size:
+        ct_data[:, :, aorta_mid + upper_gaps[0] + 1:] = 0
+    lower_gaps = np.flatnonzero(~intersection_flags[:max(aorta_mid - 1, 0)])
+    if lower_gaps.size:
+        ct_data[:, :, :lower_gaps[-1] + 1] = 0
+    return ct_data
 
-        # if there is no intersection between the two, remove the upper slice segmentation
-        if not intersection_flags.any():
-            ct_data[:, :, slc - 1] = 0
 
-    return ct_data
+def aorta_mid_slice(aorta_index):
+    """
+    A function that returns the index of the middle slice of the aorta, given the OccupancyIndex of its segmentation.
+    If the middle of the borders of the aorta is an empty slice in a gap of the segmentation, the nearest slice that
+    contains the aorta is returned (the lower one of two at the same distance)
+    """
+    lower_border, upper_border = aorta_index.axis_range(2)
+    aorta_mid = int((upper_border + lower_border) / 2)
+    aorta_slices = np.flatnonzero(aorta_index.slice_counts)
+    return int(aorta_slices[np.argmin(np.abs(aorta_slices - aorta_mid))])
 
 
 def flip_axis(nii_data, orientation_flags):
@@ -369,13 +1251,255 @@ def flip_axis(nii_data, orientation_flags):
     return nii_data
 
 
+def bounding_box(mask, padding=0):
+    """
+    A function that finds the bounding box of the non zero voxels of the given mask
+    :param padding: The number of voxels that are added to each side of the box, the box is clipped to the mask shape
+    :return the function returns the box as a tuple of slices that can be used to crop volumes of the same shape
+    """
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(i for i in range(mask.ndim) if i != axis)
+        axis_range = flags_range(np.any(mask, axis=other_axes))
+        if axis_range is None:
+            return tuple(slice(0, 0) for _ in range(mask.ndim))
+        box.append(slice(max(axis_range[0] - padding, 0), min(axis_range[1] + padding, mask.shape[axis])))
+    return tuple(box)
+
+
+def keep_largest_components(mask, k=1, per_slice=False, axis=2):
+    """
+    A function that keeps only the k largest connected components of the given 2D or 3D mask. The components are
+    labelled with full connectivity (8 in 2D, 26 in 3D) and their sizes are computed with one histogram of the labels
+    :param k: The number of components to keep
+    :param per_slice: If True, the mask is treated as a stack of 2D slices along the given axis and the k largest
+    components of every slice are kept, with a single labelling of the whole stack
+    :return the function returns a boolean mask of the kept components
+    """
+    structure = ndimage.generate_binary_structure(mask.ndim, mask.ndim)
+    if per_slice:
+        # components are not connected across slices:
+        structure = np.zeros_like(structure)
+        structure[(slice(None),) * axis + (1,)] = ndimage.generate_binary_structure(mask.ndim - 1, mask.ndim - 1)
+    labels, components_num = ndimage.label(mask, structure)
+    if components_num <= k:
+        return labels != 0
+
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    if not per_slice:
+        kept_labels = np.argsort(sizes)[-k:]
+    else:
+        # the slice of every label, taken from any of its voxels:
+        voxels = np.flatnonzero(labels)
+        label_slices = np.zeros(components_num + 1, dtype=np.intp)
+        label_slices[labels.ravel()[voxels]] = np.unravel_index(voxels, mask.shape)[axis]
+
+        # sort the labels by slice and then by decreasing size, and keep the first k labels of every slice:
+        order = np.lexsort((-sizes[1:], label_slices[1:])) + 1
+        ordered_slices = label_slices[order]
+        slice_starts = np.flatnonzero(np.r_[True, ordered_slices[1:] != ordered_slices[:-1]])
+        ranks = np.arange(order.size) - np.repeat(slice_starts, np.diff(np.r_[slice_starts, order.size]))
+        kept_labels = order[ranks < k]
+
+    kept_flags = np.zeros(components_num + 1, dtype=bool)
+    kept_flags[kept_labels] = True
+    kept_flags[0] = False
+    return kept_flags[labels]
+
+
+def fill_small_holes(mask, max_size=HOLE_MAX_SIZE, axis=2):
+    """
+    A function that fills the holes of at most max_size pixels in every slice of the given stack of 2D slices,
+    like morphology.remove_small_holes does for a single slice. The background is labelled with 4 connectivity inside
+    the slices, with a single labelling of the whole stack
+    :return the function returns the filled boolean mask
+    """
+    structure = np.zeros((3,) * mask.ndim, dtype=bool)
+    structure[(slice(None),) * axis + (1,)] = ndimage.generate_binary_structure(mask.ndim - 1, 1)
+    labels, _ = ndimage.label(~mask, structure)
+    small_flags = np.bincount(labels.ravel()) <= max_size
+    small_flags[0] = False
+    return mask | small_flags[labels]
+
+
+def keep_anchored_component(mask, anchor_slice, axis=2):
+    """
+    A function that keeps the 3D connected component of the given mask that has the most voxels in the anchor slice, or
+    the largest component if the anchor slice is empty. Voxels are connected with 8 connectivity inside a slice and to
+    the voxels directly above and below them, so a component continues to the next slice only where the slices
+    intersect, as in remove_over_segmentation
+    :return the function returns a boolean mask of the kept component
+    """
+    structure = np.zeros((3,) * mask.ndim, dtype=bool)
+    structure[(slice(None),) * axis + (1,)] = True
+    structure[(1,) * mask.ndim] = True
+    structure[(1,) * axis + (slice(None),) + (1,) * (mask.ndim - axis - 1)] = True
+    labels, components_num = ndimage.label(mask, structure)
+    if components_num <= 1:
+        return labels != 0
+
+    sizes = np.bincount(labels[(slice(None),) * axis + (anchor_slice,)].ravel(), minlength=components_num + 1)
+    sizes[0] = 0
+    if not sizes.any():
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+    return labels == np.argmax(sizes)
+
+
+def slab_ranges(depth, slab_size, overlap=0):
+    """
+    A function that divides depth slices into slabs of slab_size slices
+    :param overlap: The number of slices of the previous slab that are added to the beginning of every slab
+    :return the function returns a generator of (first, start, stop) tuples, such that the slab with its overlap is
+    [first, stop) and the slab itself is [start, stop)
+    """
+    for start in range(0, depth, slab_size):
+        yield max(start - overlap, 0), start, min(start + slab_size, depth)
+
+
+def keep_largest_component_slabs(read_slab, shape, slab_size, k=1):
+    """
+    A function that keeps only the k largest 26-connected components of a 3D mask that is read in slabs along the third
+    axis, without labelling the whole mask at once. Every slab is labelled together with the last slice of the
+    previous slab, so the components of two slabs that share a voxel of that slice are the same component, and they
+    are merged with a UnionFind. Every slice is read once, and the slabs are labelled again from the last one to the
+    first to write the kept components, so only the labels of a single slab are in memory at any time. The result is
+    the same as keep_largest_components(mask, k)
+    :param read_slab: A function that returns the slices [start, stop) of the mask for (start, stop), it is called
+    for consecutive slabs
+    :param shape: The shape of the mask
+    :return the function returns a boolean mask of the kept components
+    """
+    structure = ndimage.generate_binary_structure(3, 3)
+    components = UnionFind(1)  # label 0 is the background
+    sizes = [np.zeros(1, dtype=np.int64)]
+    slab_offsets = []
+    last_slice_labels = None
+    kept_mask = np.zeros(shape, dtype=bool)
+    for first, start, stop in slab_ranges(shape[2], slab_size, overlap=1):
+        kept_mask[:, :, start:stop] = read_slab(start, stop)
+        labels, components_num = ndimage.label(kept_mask[:, :, first:stop], structure)
+
+        # the voxels of the overlap slice were already counted in the previous slab:
+        sizes.append(np.bincount(labels[:, :, start - first:].ravel(), minlength=components_num + 1)[1:])
+        offset = components.add(components_num) - 1
+        slab_offsets.append(offset)
+        labels[labels != 0] += offset
+        if start > first:
+            # the distinct (previous label, label) pairs of the overlap slice, encoded as single integers:
+            shared_flags = last_slice_labels != 0
+            pairs = np.unique(last_slice_labels[shared_flags].astype(np.int64) * components.parent.size +
+                              labels[:, :, 0][shared_flags])
+            for previous_label, label in zip(*np.divmod(pairs, components.parent.size)):
+                components.union(previous_label, label)
+        last_slice_labels = labels[:, :, -1]
+
+    # the size of every component is the sum of the sizes of its labels:
+    roots = components.roots()
+    sizes = np.concatenate(sizes)
+    component_sizes = np.bincount(roots, weights=sizes, minlength=roots.size)
+    component_sizes[0] = 0
+    kept_flags = np.zeros(roots.size, dtype=bool)
+    kept_flags[np.argsort(component_sizes)[-k:]] = True
+    kept_flags[0] = False
+    kept_flags = kept_flags[roots]
+
+    # a slab is written after the next slab was labelled, since it is the overlap slice of the next slab:
+    for (first, start, stop), offset in reversed(list(zip(slab_ranges(shape[2], slab_size, overlap=1),
+                                                          slab_offsets))):
+        labels = ndimage.label(kept_mask[:, :, first:stop], structure)[0]
+        labels[labels != 0] += offset
+        kept_mask[:, :, start:stop] = kept_flags[labels[:, :, start - first:]]
+    return kept_mask
+
+
+class UnionFind:
+    """
+    A class that keeps a partition of the labels 0..n-1 into sets, for merging the labels of connected components
+    """
+
+    def __init__(self, size=0):
+        self.parent = np.arange(size)
+
+    def add(self, count):
+        """
+        A function that adds count new labels, each in its own set
+        :return the function returns the first new label
+        """
+        first = self.parent.size
+        self.parent = np.concatenate([self.parent, np.arange(first, first + count)])
+        return first
+
+    def find(self, label):
+        """
+        A function that returns the representative of the set of the given label, and compresses the path to it
+        """
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, label, other_label):
+        """
+        A function that merges the sets of the given labels. The smaller representative represents the merged set
+        """
+        root, other_root = self.find(label), self.find(other_label)
+        if root != other_root:
+            self.parent[max(root, other_root)] = min(root, other_root)
+
+    def roots(self):
+        """
+        A function that returns the representative of every label, as an array
+        """
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+
+def dilate_disk(mask, radius, spacing=None):
+    """
+    A function that dilates the given mask with a disk (a ball in 3D) of the given radius. The dilation is a threshold
+    on the distance transform of the background, so its cost does not depend on the radius. With spacing=None the
+    result is the same as morphology.dilation(mask, morphology.disk(radius))
+    :param radius: The radius in voxels, or in mm if spacing is given
+    :param spacing: The voxel spacing in mm along every axis of the mask, e.g. pixdim[1:3] for an axial slice
+    :return the function returns the dilated mask as a boolean array
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return mask.copy()
+    return ndimage.distance_transform_edt(np.logical_not(mask), sampling=spacing) <= radius
+
+
+def uncrop(cropped_data, box, shape):
+    """
+    A function that pastes a volume that was cropped with the given box back into a zero volume of the given shape
+    """
+    data = np.zeros(shape, dtype=cropped_data.dtype)
+    data[box] = cropped_data
+    return data
+
+
 def img_orientation(ctFileName):
     """
     A function that determines the orientation of the given CT scan. The code handles images in 'R,P,S' orientation
     """
     ct_img = nib.load(ctFileName)
+    return orientation_from_affine(ct_img.affine)
+
+
+def orientation_from_affine(affine):
+    """
+    A function that computes the orientation flags of a scan from its affine, see img_orientation
+    """
     orientation_flags = np.zeros(3)
-    orientation = nib.aff2axcodes(ct_img.affine)
+    orientation = nib.aff2axcodes(affine)
 
     if orientation[0] != 'R':
         orientation_flags[0] = True
@@ -387,83 +1511,133 @@ def img_orientation(ctFileName):
     return orientation_flags
 
 
-def calc_ASSD(ground_truth_segmentation, estimated_segmentation):
-    # true_seg = ground_truth_segmentation
-    # est_seg = estimated_segmentation
-
-    liver_true_seg = nib.load(ground_truth_segmentation)
-    liver_true_data = liver_true_seg.get_data()
+def calc_ASSD(ground_truth_segmentation, estimated_segmentation, volume_cache=None):
+    """
+    A function that computes the average symmetric surface distance in mm between the given segmentations
+    :param ground_truth_segmentation: The path to the true segmentation of the liver
+    :param estimated_segmentation: The path to the segmentation created in the segmentLiver function
+    :param volume_cache: A cache.VolumeCache to load the segmentations through
+    """
+    liver_true_seg = load_nifti(ground_truth_segmentation, volume_cache)
+    liver_true_data = np.asanyarray(liver_true_seg.dataobj)
     header = liver_true_seg.header
 
+    liver_est_seg = load_nifti(estimated_segmentation, volume_cache)
+    liver_est_data = np.asanyarray(liver_est_seg.dataobj)
+
+    return surface_metrics(liver_true_data, liver_est_data, header['pixdim'][1:4],
+                           true_file_name=ground_truth_segmentation, est_file_name=estimated_segmentation).ASSD
+
+
+def surface_metrics(true_seg_data, est_seg_data, spacing, surface_tolerance=SURFACE_TOLERANCE, true_file_name=None,
+                    est_file_name=None):
+    """
+    A function that computes all the surface distance metrics of two segmentations. The surfaces are extracted once and
+    the distances of each surface from the other one are computed once, and all the metrics are derived from them
+    :param spacing: The size of a voxel along each axis in mm, e.g. pixdim[1:4] of the nifti header
+    :param surface_tolerance: The tolerance in mm of the surface dice
+    :param true_file_name: The file the true segmentation was loaded from, used as part of the key of the surface cache
+    :param est_file_name: The file the estimated segmentation was loaded from, see true_file_name
+    :return: A SurfaceMetrics with the ASSD, Hausdorff distance, 95th percentile Hausdorff distance and surface dice
+    """
+    true_points = cached_surface_points(true_seg_data, file_name=true_file_name)
+    est_points = cached_surface_points(est_seg_data, file_name=est_file_name)
+    if not true_points.size or not est_points.size:
+        return SurfaceMetrics(np.nan, np.nan, np.nan, np.nan, surface_tolerance)
+
+    # only the bounding box of both surfaces is processed:
+    corner = np.minimum(true_points.min(axis=0), est_points.min(axis=0))
+    box_shape = np.maximum(true_points.max(axis=0), est_points.max(axis=0)) - corner + 1
+    true_surface = np.zeros(box_shape, dtype=bool)
+    true_surface[tuple((true_points - corner).T)] = True
+    est_surface = np.zeros(box_shape, dtype=bool)
+    est_surface[tuple((est_points - corner).T)] = True
+
+    true_distances = surface_distances(true_surface, est_surface, spacing)
+    est_distances = surface_distances(est_surface, true_surface, spacing)
+
+    ASSD = (np.mean(true_distances) + np.mean(est_distances)) / 2
+    hausdorff = max(np.max(true_distances), np.max(est_distances))
+    hausdorff_95 = max(np.percentile(true_distances, 95), np.percentile(est_distances, 95))
+    surface_dice = ((np.count_nonzero(true_distances <= surface_tolerance) +
+                     np.count_nonzero(est_distances <= surface_tolerance)) /
+                    (true_distances.size + est_distances.size))
 
-    liver_est_seg = nib.load(estimated_segmentation)
-    liver_est_data = liver_est_seg.get_data()
-
-    # find the surface of the true segmentation:
-    derivation_matrix = np.array([[0, 0, 0], [1, 0, -1], [0, 0, 0]])
-    for slc in range(liver_true_seg.shape[2]):
-        if liver_true_data[:, :, slc].any():
-            dx = convolve2d(liver_true_data[:, :, slc], derivation_matrix, mode='same', boundary='wrap')
-            dy = convolve2d(liver_true_data[:, :, slc], derivation_matrix.T, mode='same', boundary='wrap')
-            liver_true_data[:, :, slc] = np.sqrt(
-                np.abs(dx) ** 2 + np.abs(dy) ** 2)  # calculates the magnitude of dx and dy
-            liver_true_data[:, :, slc], connected_components_num = measure.label(liver_true_data[:, :, slc],
-                                                                                 return_num=True)
-            props = measure.regionprops(liver_true_data[:, :, slc].astype(np.uint16), coordinates='rc')
-            area_list = [region.area for region in props]
-            liver_true_data[:, :, slc] = morphology.remove_small_objects(liver_true_data[:, :, slc].astype(np.uint8),
-                                                                         min_size=max(area_list))
-    # liver_true_data[liver_true_seg!=0]=1
-    nib.save(liver_true_seg, 'true_surface.nii.gz')
-
-    # find the surface of the estimated segmentation:
-    for slc in range(liver_true_seg.shape[2]):
-        if liver_est_data[:, :, slc].any():
-            dx = convolve2d(liver_est_data[:, :, slc], derivation_matrix, mode='same', boundary='wrap')
-            dy = convolve2d(liver_est_data[:, :, slc], derivation_matrix.T, mode='same', boundary='wrap')
-            liver_est_data[:, :, slc] = np.sqrt(
-                np.abs(dx) ** 2 + np.abs(dy) ** 2)  # calculates the magnitude of dx and dy
-            liver_est_data[:, :, slc], connected_components_num = measure.label(liver_est_data[:, :, slc],
-                                                                                return_num=True)
-            props = measure.regionprops(liver_est_data[:, :, slc].astype(np.uint16), coordinates='rc')
-            area_list = [region.area for region in props]
-            liver_est_data[:, :, slc] = morphology.remove_small_objects(liver_est_data[:, :, slc].astype(np.uint8),
-                                                                        min_size=max(area_list))
-
-    true_seg_surface = np.argwhere(liver_true_data)
-    est_seg_surface = np.argwhere(liver_est_data)
-
-    # est_seg_surface = np.argwhere(liver_true_data)
-
-    pixdim = header['pixdim']
-
-    ASSD = 0
-    # j = 0
-    print('starting first')
-    for a_point in true_seg_surface:
-        # if not j%1000:
-        #     print(j)
-        #     print(ASSD)
-        # j += 1
-        ASSD += min_dist(a_point, est_seg_surface, pixdim) / true_seg_surface.shape[0]
-
-    print('starting second')
-    for b_point in est_seg_surface:
-        ASSD += min_dist(b_point, true_seg_surface, pixdim) / est_seg_surface.shape[0]
-
-    return ASSD / 2
+    return SurfaceMetrics(ASSD, hausdorff, hausdorff_95, surface_dice, surface_tolerance)
+
+
+def mask_hash(mask):
+    """
+    A function that returns a hash of the shape and the non zero voxels of the given mask
+    """
+    mask = np.asarray(mask) != 0
+    sha = hashlib.sha1(np.packbits(mask))
+    sha.update(str(mask.shape).encode())
+    return sha.hexdigest()
+
+
+def find_surface(seg_data, connectivity=6):
+    """
+    A function that finds the surface of the given segmentation in one pass, as the segmentation minus its erosion.
+    Voxels on the border of the volume are surface voxels if they are in the segmentation
+    :param seg_data: A 2D or 3D segmentation
+    :param connectivity: The neighbourhood that is used for the erosion, 6, 18 or 26 for 3D and 4 or 8 for 2D. A voxel
+    is on the surface if one of its neighbours is not in the segmentation
+    :return the function returns a boolean array in which the surface voxels are True
+    """
+    if (seg_data.ndim, connectivity) not in SURFACE_CONNECTIVITY:
+        raise ValueError('connectivity %r is not supported for %dD segmentations' % (connectivity, seg_data.ndim))
+    mask = seg_data != 0
+    structure = ndimage.generate_binary_structure(mask.ndim, SURFACE_CONNECTIVITY[mask.ndim, connectivity])
+    return np.logical_and(mask, np.logical_not(ndimage.binary_erosion(mask, structure, border_value=0)))
+
+
+def cached_surface_points(seg_data, connectivity=6, file_name=None):
+    """
+    A function that returns the coordinates of the surface voxels of the given segmentation, see find_surface. The
+    results are memoized by the file name and a hash of the segmentation, so evaluating several segmentations against
+    the same ground truth extracts its surface only once
+    :return the function returns an (N, ndim) array of coordinates, as np.argwhere
+    """
+    mask = seg_data != 0
+    key = (file_name, connectivity, mask_hash(mask))
+    if key in _surface_cache:
+        _surface_cache.move_to_end(key)
+        return _surface_cache[key]
+
+    box = bounding_box(mask, 1)
+    points = np.argwhere(find_surface(mask[box], connectivity))
+    points += [axis_slice.start for axis_slice in box]
+    points.setflags(write=False)
+
+    _surface_cache[key] = points
+    if len(_surface_cache) > SURFACE_CACHE_SIZE:
+        _surface_cache.popitem(last=False)
+    return points
+
+
+def surface_distances(surface, other_surface, spacing):
+    """
+    A function that computes the distance of every voxel of the given surface from the closest voxel of the other
+    surface, using a Euclidean distance transform of the other surface
+    :param spacing: The size of a voxel along each axis, the distances are in the same units
+    :return the function returns a 1D array with a distance for every voxel of the surface
+    """
+    distance_map = ndimage.distance_transform_edt(np.logical_not(other_surface), sampling=spacing)
+    return distance_map[surface]
 
 
 def min_dist(point, surface, pixdim):
     """
-    A function that computes the minimal distance of the given point from the given surface
+    A function that computes the minimal distance of the given point from the given surface. This is a brute force
+    reference for surface_distances
+    :param surface: An array of the coordinates of the surface voxels, as returned by np.argwhere
+    :param pixdim: The pixdim field of the nifti header
     """
-    point_array = np.full(surface.shape, point)
-    dist_array = np.linalg.norm(point_array-surface, axis=1)
+    dist_array = np.linalg.norm((surface - point) * pixdim[1:4], axis=1)
     return np.amin(dist_array)
 
 
-
 ##############################################################################
 # uncomment 'main' and fill case number instead '#' for running the program  #
 ##############################################################################
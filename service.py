@@ -0,0 +1,270 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from batch import error_message, evaluate_pair, run_case
+from cache import StageCache, VolumeCache
+from ex3 import OutputFormat, SegmentationParams, evaluateSegmentation, segmentLiver
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'liver_segmentation.sock')
+SCRATCH_ROOT = os.path.join(tempfile.gettempdir(), 'liver_segmentation_jobs')
+WARM_UP_SHAPE = (64, 64, 8)  # shape of the phantom that the service segments once before it accepts jobs
+LATENCY_HISTORY = 1000  # latencies of the most recent jobs that the statistics are computed from
+
+
+##############
+# USER GUIDE #
+##############
+# Runs a long lived worker service, so many small jobs do not pay for starting Python and importing the modules:
+#     python service.py serve --workers 4 --max-pending 16 --stage-cache --volume-cache
+# The service imports ex3.py and its dependencies once, warms them up by segmenting and evaluating a small phantom (see
+# benchmark.py), and only then forks its worker processes, which inherit the warm modules. It keeps a StageCache and a
+# VolumeCache (see cache.py, both are safe to share between processes) for all the jobs if --stage-cache and
+# --volume-cache are given. Jobs are received over a unix socket (--socket, by default in the temporary directory), and
+# at most --max-pending jobs are queued or running at once, later jobs wait for a free place
+# The stub client submits a job and waits for its result:
+#     python service.py segment ct.nii.gz aorta.nii.gz output --seed 0
+#     python service.py evaluate ground_truth.nii.gz estimated.nii.gz
+#     python service.py stats
+#     python service.py shutdown
+# A job is one JSON line {"type": "segment", "ct": ..., "aorta": ..., "output": ..., "seed": ..., "params": {...}} or
+# {"type": "evaluate", "ground_truth": ..., "estimated": ...}, and its result is one JSON line with the fields of the
+# summary table or of the report of batch.py, and the latency of the job: the time it waited for a worker (queue_s),
+# the time it ran (run_s) and their sum (latency_s). Segmentation jobs run in scratch directories as in batch.py. The
+# workers are not restarted between jobs, so the peak memory of a segmentation job is reported as the peak of its worker
+# process so far (worker_peak_memory_mb), which may come from an earlier and larger job
+
+
+def run_job(job, scratch_dir, stage_cache=None, volume_cache=None, output_format=None):
+    """
+    A function that runs a single job in a worker process
+    :param job: A dict with the 'type' of the job ('segment' or 'evaluate') and its arguments, see the user guide
+    :param scratch_dir: The scratch directory of a segmentation job, see batch.run_case
+    :return the function returns the result of batch.run_case or batch.evaluate_pair, with the time at which the job
+    started (started_at, as time.time) and its running time (run_s). The peak memory of run_case is the peak of the
+    worker process since it was forked, so it is returned as worker_peak_memory_mb
+    """
+    started_at = time.time()
+    if job['type'] == 'segment':
+        case = {key: os.path.abspath(job[key]) for key in ('ct', 'aorta', 'output')}
+        result = run_case(case, scratch_dir, rng=job.get('seed'), params=SegmentationParams(**job.get('params', {})),
+                          stage_cache=stage_cache, volume_cache=volume_cache, output_format=output_format)
+        result['worker_peak_memory_mb'] = result.pop('peak_memory_mb')
+    elif job['type'] == 'evaluate':
+        pair = {'case': job.get('case'), 'ground_truth': os.path.abspath(job['ground_truth']),
+                'estimated': os.path.abspath(job['estimated'])}
+        result = evaluate_pair(pair, volume_cache)
+    else:
+        raise ValueError('Unknown job type: %s' % job['type'])
+    result['started_at'] = started_at
+    result['run_s'] = round(time.time() - started_at, 3)
+    return result
+
+
+def warm_up():
+    """
+    A function that segments and evaluates a small phantom, so the modules of the pipeline are imported and their first
+    calls (e.g. the lazy imports of scipy) are done before the worker processes are forked
+    :return the function returns the time in seconds that the warm up took
+    """
+    from benchmark import make_phantom, phantom_params
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        ct_file_name, aorta_file_name, liver_file_name = make_phantom(directory, WARM_UP_SHAPE)
+        output_file_name = segmentLiver(ct_file_name, aorta_file_name, os.path.join(directory, 'warm_up'), rng=0,
+                                        params=phantom_params(WARM_UP_SHAPE))
+        evaluateSegmentation(liver_file_name, output_file_name)
+    return time.perf_counter() - start
+
+
+class SegmentationService:
+    """
+    A class that runs segmentation and evaluation jobs in a pool of warm worker processes, and keeps the latencies of
+    the jobs. At most max_pending jobs are queued or running at once, submit waits for a free place
+    """
+
+    def __init__(self, workers=None, max_pending=None, scratch_root=SCRATCH_ROOT, stage_cache=None, volume_cache=None,
+                 output_format=None):
+        """
+        :param workers: The number of worker processes, by default the number of CPUs
+        :param max_pending: The number of jobs that may be queued or running at once, by default twice the workers
+        :param scratch_root: The directory in which the scratch directory of every segmentation job is created
+        :param stage_cache: A cache.StageCache that is shared by all the jobs, or None
+        :param volume_cache: A cache.VolumeCache that is shared by all the jobs, or None
+        :param output_format: The OutputFormat of the segmentations, see ex3.py
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.scratch_root = os.path.abspath(scratch_root)
+        self.options = {'stage_cache': stage_cache, 'volume_cache': volume_cache, 'output_format': output_format}
+        self.warm_up_s = warm_up()
+        self.pool = multiprocessing.get_context('fork').Pool(self.workers)
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * self.workers)
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._jobs = {'ok': 0, 'failed': 0}
+
+    def submit(self, job):
+        """
+        A function that runs the given job in the pool and waits for its result, see run_job
+        :return the function returns the result of the job with its id and its latency, and the status 'failed' and the
+        error if the job raised an exception
+        """
+        received_at = time.time()
+        job_id = next(self._job_ids)
+        with self._pending:
+            try:
+                scratch_dir = os.path.join(self.scratch_root, 'job_%d' % job_id)
+                result = self.pool.apply(run_job, (job, scratch_dir), self.options)
+            except Exception as e:
+                result = {'status': 'failed', 'error': error_message(e), 'started_at': received_at,
+                          'run_s': round(time.time() - received_at, 3)}
+        result['job'] = job_id
+        result['queue_s'] = round(result.pop('started_at') - received_at, 3)
+        result['latency_s'] = round(time.time() - received_at, 3)
+
+        with self._lock:
+            self._jobs['ok' if result['status'] == 'ok' else 'failed'] += 1
+            self._latencies = (self._latencies + [result['latency_s']])[-LATENCY_HISTORY:]
+        return result
+
+    def stats(self):
+        """
+        A function that returns the number of jobs that were run and the statistics of the latencies of the recent jobs
+        """
+        with self._lock:
+            stats = dict(self._jobs, workers=self.workers, warm_up_s=round(self.warm_up_s, 3))
+            if self._latencies:
+                stats.update(mean_latency_s=float(np.mean(self._latencies)),
+                             median_latency_s=float(np.median(self._latencies)),
+                             p95_latency_s=float(np.percentile(self._latencies, 95)))
+        return stats
+
+    def close(self):
+        """
+        A function that waits for the running jobs and stops the worker processes
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    A class that handles a connection to the service. Every line that is received is a JSON request, which is a job,
+    {"type": "stats"} or {"type": "shutdown"}, and it is answered with one JSON line
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request['type'] == 'stats':
+                    response = self.server.service.stats()
+                elif request['type'] == 'shutdown':
+                    response = {'status': 'shutting down'}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    response = self.server.service.submit(request)
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'status': 'failed', 'error': 'Bad request: ' + error_message(e)}
+            self.wfile.write((json.dumps(response, default=float) + '\n').encode())
+
+
+class ServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A class of the unix socket server of a SegmentationService, which handles every connection in its own thread
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, JobHandler)
+        self.service = service
+
+
+def serve(socket_path=SOCKET_PATH, **service_options):
+    """
+    A function that runs a SegmentationService on the given unix socket until a shutdown request is received
+    :param service_options: Keyword arguments for SegmentationService
+    """
+    service = SegmentationService(**service_options)
+    print('warmed up in %.2f s, serving %d workers on %s' % (service.warm_up_s, service.workers, socket_path))
+    try:
+        with ServiceServer(socket_path, service) as server:
+            server.serve_forever()
+    finally:
+        service.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(request, socket_path=SOCKET_PATH):
+    """
+    A function of the stub client, which sends a single request to the service and waits for its response
+    :param request: A job or a stats or shutdown request, see JobHandler
+    :return the function returns the response of the service as a dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(request) + '\n').encode())
+        with connection.makefile() as f:
+            return json.loads(f.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run or use a warm service for the segmentation of the liver')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='path of the unix socket of the service')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    serve_parser.add_argument('--max-pending', type=int, default=None,
+                              help='jobs that may be queued or running at once (default: twice the workers)')
+    serve_parser.add_argument('--scratch', default=SCRATCH_ROOT, help='directory for the scratch directories of jobs')
+    serve_parser.add_argument('--stage-cache', action='store_true', help='reuse the results of the stages between jobs')
+    serve_parser.add_argument('--volume-cache', action='store_true', help='cache the decompressed input volumes')
+    serve_parser.add_argument('--compress-level', type=int, default=OutputFormat.compress_level,
+                              help='gzip level of the segmentations, from 0 (fastest) to 9 (smallest)')
+    serve_parser.add_argument('--no-compress', action='store_true', help='save uncompressed .nii segmentations')
+
+    segment_parser = subparsers.add_parser('segment', help='submit a segmentation job')
+    segment_parser.add_argument('ct')
+    segment_parser.add_argument('aorta')
+    segment_parser.add_argument('output', help='name of the segmentation file without an extension')
+    segment_parser.add_argument('--seed', type=int, default=None, help='seed for the selection of the seeds')
+    segment_parser.add_argument('--params', default='{}', help='a JSON object of SegmentationParams fields')
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='submit an evaluation job')
+    evaluate_parser.add_argument('ground_truth')
+    evaluate_parser.add_argument('estimated')
+
+    subparsers.add_parser('stats', help='print the statistics of the latencies of the jobs')
+    subparsers.add_parser('shutdown', help='stop the service after the running jobs')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, workers=args.workers, max_pending=args.max_pending, scratch_root=args.scratch,
+              stage_cache=StageCache() if args.stage_cache else None,
+              volume_cache=VolumeCache() if args.volume_cache else None,
+              output_format=OutputFormat(compressed=not args.no_compress, compress_level=args.compress_level))
+    else:
+        if args.command == 'segment':
+            request = {'type': 'segment', 'ct': os.path.abspath(args.ct), 'aorta': os.path.abspath(args.aorta),
+                       'output': os.path.abspath(args.output), 'seed': args.seed, 'params': json.loads(args.params)}
+        elif args.command == 'evaluate':
+            request = {'type': 'evaluate', 'ground_truth': os.path.abspath(args.ground_truth),
+                       'estimated': os.path.abspath(args.estimated)}
+        else:
+            request = {'type': args.command}
+        print(json.dumps(submit(request, args.socket), indent=2))
@@ -0,0 +1,165 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from dataclasses import asdict, fields
+
+import numpy as np
+
+from batch import METRIC_FIELDS, error_message, read_manifest, write_table
+from ex3 import PipelineContext, SegmentationParams, IsolateBody, evaluateSegmentation, find_ROI, segment_context
+
+CASE_COLUMNS = ('ct', 'aorta', 'ground_truth')
+PARAM_FIELDS = [field.name for field in fields(SegmentationParams)]
+SCORE_FIELDS = [name for name in METRIC_FIELDS if name != 'surface_tolerance']
+RANK_METRIC = 'dice_coefficient'
+RANKING_FIELDS = ['rank', 'configuration'] + PARAM_FIELDS + ['mean_' + name for name in SCORE_FIELDS] + \
+                 ['mean_runtime_s', 'cases', 'failed']
+
+# the context of the case that is swept, inherited by the forked worker processes:
+_sweep_context = None
+
+
+##############
+# USER GUIDE #
+##############
+# Searches a grid of SegmentationParams for the best segmentation of a set of cases:
+#     python sweep.py cases.csv grid.json --workers 4 --output sweep --seed 0
+# The cases file is a CSV file with the columns ct, aorta and ground_truth, or a JSON list of objects with these keys.
+# The grid file is a JSON object from names of SegmentationParams fields to lists of values, for example
+#     {"seeds_num": [100, 200], "stratified_seeds": [false, true], "skin_radius": [40, 60]}
+# and every combination of the values is a configuration. The CT and aorta of every case are loaded, and the body and
+# the ROIs (one for every skin radius of the grid) are found, only once. The stages that depend on the other parameters
+# run for all the configurations in parallel in forked worker processes, which share the loaded volumes of the case
+# The segmentation of every configuration is saved in the output directory and scored with evaluateSegmentation. The
+# configurations ranked by their mean dice coefficient are written to '<output>/ranking.csv', and the scores of every
+# case and configuration to '<output>/results.json'
+
+
+def parameter_grid(grid):
+    """
+    A function that returns the configurations of the given grid
+    :param grid: A dict from names of SegmentationParams fields to lists of values. Missing fields keep their defaults
+    :return the function returns a list of SegmentationParams, one for every combination of the values
+    """
+    unknown = set(grid) - set(PARAM_FIELDS)
+    if unknown:
+        raise ValueError('Unknown parameters in the grid: %s' % ', '.join(sorted(unknown)))
+    names = list(grid)
+    return [SegmentationParams(**dict(zip(names, values))) for values in itertools.product(*grid.values())]
+
+
+def run_configuration(task):
+    """
+    A function that segments the case of _sweep_context with a single configuration, saves the segmentation and scores
+    it against the ground truth
+    :param task: A tuple of the index of the configuration, its SegmentationParams, the path to the ground truth, the
+    output file name (without an extension) and the seed of the seeds selection
+    :return the function returns a dict with the index of the configuration, its status, runtime and metrics
+    """
+    index, params, ground_truth, output_file_name, rng = task
+    result = {'configuration': index, 'status': 'ok', 'error': ''}
+    start = time.perf_counter()
+    try:
+        liver_data = segment_context(_sweep_context, rng, params)
+        output_file_name = _sweep_context.save_volume(liver_data, output_file_name)
+        result.update(asdict(evaluateSegmentation(ground_truth, output_file_name)))
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = error_message(e)
+    result['runtime_s'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def sweep_case(case, configurations, output_dir, workers=None, rng=None):
+    """
+    A function that runs all the configurations on a single case. The shared stages (loading, orientation, body
+    segmentation and the ROIs) run once in this process, and the configurations run in a pool of forked worker
+    processes that inherit them
+    :return the function returns a list of result dicts, see run_configuration, in the order of the configurations
+    """
+    global _sweep_context
+    case_name = os.path.basename(case['ct']).split('.nii')[0]
+    case_dir = os.path.join(output_dir, case_name)
+    os.makedirs(case_dir, exist_ok=True)
+
+    _sweep_context = PipelineContext(case['ct'], case['aorta'])
+    IsolateBody(_sweep_context)
+    for skin_radius, skin_radius_mm in {(params.skin_radius, params.skin_radius_mm) for params in configurations}:
+        find_ROI(_sweep_context, params=SegmentationParams(skin_radius=skin_radius, skin_radius_mm=skin_radius_mm))
+
+    tasks = [(index, params, case['ground_truth'], os.path.join(case_dir, 'configuration_%d' % index), rng)
+             for index, params in enumerate(configurations)]
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(run_configuration, tasks, chunksize=1)
+    finally:
+        _sweep_context = None
+    for result in results:
+        result['case'] = case_name
+    return results
+
+
+def rank_configurations(configurations, results):
+    """
+    A function that averages the scores of every configuration over the cases and ranks the configurations by their
+    mean RANK_METRIC. A configuration that failed on any case is ranked last
+    :return the function returns the rows of the ranking table, see RANKING_FIELDS
+    """
+    rows = []
+    for index, params in enumerate(configurations):
+        configuration_results = [result for result in results if result['configuration'] == index]
+        ok_results = [result for result in configuration_results if result['status'] == 'ok']
+        row = dict(asdict(params), configuration=index, cases=len(configuration_results),
+                   failed=len(configuration_results) - len(ok_results))
+        for name in SCORE_FIELDS + ['runtime_s']:
+            values = [result[name] for result in ok_results]
+            row['mean_' + name] = float(np.mean(values)) if values else float('nan')
+        rows.append(row)
+
+    rows.sort(key=lambda row: (row['failed'] > 0, -np.nan_to_num(row['mean_' + RANK_METRIC], nan=-np.inf)))
+    for rank, row in enumerate(rows, start=1):
+        row['rank'] = rank
+    return rows
+
+
+def run_sweep(cases, grid, output_dir='sweep', workers=None, rng=0):
+    """
+    A function that runs a parameter sweep over the given cases
+    :param cases: A list of dicts with 'ct', 'aorta' and 'ground_truth' keys, see read_manifest
+    :param grid: A dict from names of SegmentationParams fields to lists of values, see parameter_grid
+    :param output_dir: The directory of the segmentations and of the ranking and results files
+    :param workers: The number of worker processes, by default the number of CPUs
+    :param rng: The seed of the seeds selection, the same for all the configurations so they are comparable
+    :return the function returns the ranking table, see rank_configurations
+    """
+    configurations = parameter_grid(grid)
+    results = []
+    for case in cases:
+        print('sweeping %s over %d configurations' % (case['ct'], len(configurations)))
+        results.extend(sweep_case(case, configurations, output_dir, workers, rng))
+
+    ranking = rank_configurations(configurations, results)
+    write_table(ranking, os.path.join(output_dir, 'ranking.csv'), RANKING_FIELDS)
+    with open(os.path.join(output_dir, 'results.json'), 'w') as f:
+        json.dump({'configurations': [asdict(params) for params in configurations], 'results': results}, f, indent=2)
+    return ranking
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search a grid of parameters for the best segmentation of the liver')
+    parser.add_argument('cases', help='a CSV or JSON file with the ct, aorta and ground_truth of every case')
+    parser.add_argument('grid', help='a JSON file from parameter names to lists of values')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    parser.add_argument('--output', default='sweep', help='directory for the segmentations and the ranking')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the selection of the seeds')
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    ranking = run_sweep(read_manifest(args.cases, CASE_COLUMNS), grid, args.output, args.workers, args.seed)
+    for row in ranking[:10]:
+        params = ', '.join('%s=%s' % (name, row[name]) for name in PARAM_FIELDS)
+        print('%3d  %s=%.4f  %s' % (row['rank'], RANK_METRIC, row['mean_' + RANK_METRIC], params))